@@ -0,0 +1,80 @@
+import json
+import os
+import boto3
+from botocore.exceptions import ClientError
+from analytics import ANALYTICS_SNAPSHOT_KEY, fold_events
+
+s3_client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+BUCKET_NAME = os.environ.get('BUCKET_NAME', 'awslambda0521')
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Expose-Headers': 'ETag'
+}
+
+def lambda_handler(event, context):
+    """返回預先計算好的統計快照（單次 S3 讀取，不隨用戶數或文件數增加）
+
+    EventBridge 排程呼叫時只彙整待處理的統計事件（見 analytics.fold_events），
+    快照最多落後一個排程週期。
+    """
+    if event.get('source') == 'aws.events':
+        return {'statusCode': 200, 'body': json.dumps({'folded': fold_events(s3_client, BUCKET_NAME)})}
+
+    http_method = (
+        event.get('httpMethod') or
+        event.get('requestContext', {}).get('http', {}).get('method', '')
+    )
+    if http_method.upper() == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': json.dumps('CORS OK')}
+
+    query_params = event.get('queryStringParameters', {}) or {}
+    if query_params.get('username') != 'admin':
+        return response(403, '僅限管理員使用')
+
+    try:
+        # 只讀取快照：待處理事件由排程彙整，請求延遲不隨事件數或用戶數增加
+        headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+        if_none_match = headers.get('if-none-match')
+        kwargs = {'IfNoneMatch': if_none_match} if if_none_match else {}
+        try:
+            snapshot = s3_client.get_object(Bucket=BUCKET_NAME, Key=ANALYTICS_SNAPSHOT_KEY, **kwargs)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                return {'statusCode': 304, 'headers': {**CORS_HEADERS, 'ETag': if_none_match}, 'body': ''}
+            if code == 'NoSuchKey':
+                return response(404, '統計資料尚未產生')
+            raise e
+
+        # 快照已是 JSON，直接轉送不重新解析
+        return {
+            'statusCode': 200,
+            'headers': {
+                **CORS_HEADERS,
+                'Content-Type': 'application/json',
+                'ETag': snapshot['ETag'],
+                'Cache-Control': 'no-cache'
+            },
+            'body': snapshot['Body'].read().decode('utf-8')
+        }
+
+    except ClientError as e:
+        print(f"AWS ClientError: {str(e)}")
+        return response(500, 'AWS操作失敗，請稍後再試')
+
+    except Exception as e:
+        print(f"Unexpected Error: {str(e)}")
+        return response(500, '伺服器內部錯誤')
+
+def response(status_code, message):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            **CORS_HEADERS,
+            'Content-Type': 'application/json'
+        },
+        'body': json.dumps({'message': message}, ensure_ascii=False)
+    }
@@ -0,0 +1,247 @@
+"""管理員統計快照：由登入、註冊、上傳與刪除事件增量維護
+
+analytics/events/<日期>/ 每個事件一個小物件，請求端只寫入一次，不讀取也不與其他請求競爭
+analytics/state.json     每位用戶的活躍日與用量等維護快照所需的狀態（僅彙整端讀寫）
+analytics/snapshot.json  預先計算好的統計結果，大小固定，管理員端點直接返回
+
+事件由 fold_events 定期整批套用到狀態並重新產生快照（排程呼叫 admin_analytics_lambda，
+管理員讀取快照前也會先彙整），快照的延遲即為排程間隔。
+
+用法:
+    python analytics.py rebuild   以現有資料初始化或重建狀態
+    python analytics.py fold      立即彙整待處理的事件
+"""
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+ANALYTICS_STATE_KEY = 'analytics/state.json'
+ANALYTICS_SNAPSHOT_KEY = 'analytics/snapshot.json'
+ANALYTICS_EVENTS_PREFIX = 'analytics/events/'
+
+ACTIVE_DAYS = 30          # 最近幾天內有登入或上傳即視為活躍用戶
+HISTORY_DAYS = 90         # 每日統計保留天數
+TOP_USERS = 10
+FOLD_BATCH = 10000        # 每次彙整最多處理的事件數（其餘留待下次）
+FOLD_WORKERS = 16
+
+def today():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+def empty_state():
+    return {'users': {}, 'loginsPerDay': {}, 'uploadsPerDay': {}, 'uploadBytesPerDay': {}}
+
+def load_state(s3_client, bucket):
+    """讀取狀態與其 ETag（用於條件寫入），不存在時返回空狀態"""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=ANALYTICS_STATE_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return empty_state(), None
+        raise e
+    return json.loads(response['Body'].read()), response['ETag']
+
+def apply_event(state, event_type, username, day, size_bytes=0):
+    """將單一事件套用到狀態"""
+    users = state['users']
+    if event_type == 'register':
+        users.setdefault(username, {'lastActive': None, 'bytes': 0, 'files': 0})
+    elif event_type == 'login':
+        user = users.setdefault(username, {'lastActive': None, 'bytes': 0, 'files': 0})
+        user['lastActive'] = day
+        state['loginsPerDay'][day] = state['loginsPerDay'].get(day, 0) + 1
+    elif event_type == 'upload':
+        user = users.setdefault(username, {'lastActive': None, 'bytes': 0, 'files': 0})
+        user['lastActive'] = day
+        user['bytes'] += size_bytes
+        user['files'] += 1
+        state['uploadsPerDay'][day] = state['uploadsPerDay'].get(day, 0) + 1
+        state['uploadBytesPerDay'][day] = state['uploadBytesPerDay'].get(day, 0) + size_bytes
+    elif event_type == 'delete':
+        user = users.get(username)
+        if user:
+            user['bytes'] = max(0, user['bytes'] - size_bytes)
+            user['files'] = max(0, user['files'] - 1)
+
+def prune_history(state, day):
+    """只保留最近 HISTORY_DAYS 天的每日統計"""
+    oldest = (datetime.strptime(day, '%Y-%m-%d') - timedelta(days=HISTORY_DAYS - 1)).strftime('%Y-%m-%d')
+    for series in ('loginsPerDay', 'uploadsPerDay', 'uploadBytesPerDay'):
+        state[series] = {d: v for d, v in state[series].items() if d >= oldest}
+
+def build_snapshot(state, day):
+    """由狀態計算固定大小的統計快照"""
+    active_since = (datetime.strptime(day, '%Y-%m-%d') - timedelta(days=ACTIVE_DAYS - 1)).strftime('%Y-%m-%d')
+    users = state['users']
+    top = sorted(users.items(), key=lambda item: item[1]['bytes'], reverse=True)[:TOP_USERS]
+    return {
+        'generatedAt': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+        'userCount': len(users),
+        'activeUsers': sum(1 for user in users.values() if user['lastActive'] and user['lastActive'] >= active_since),
+        'activeDays': ACTIVE_DAYS,
+        'totalFiles': sum(user['files'] for user in users.values()),
+        'totalBytes': sum(user['bytes'] for user in users.values()),
+        'loginsPerDay': dict(sorted(state['loginsPerDay'].items())),
+        'uploadsPerDay': dict(sorted(state['uploadsPerDay'].items())),
+        'uploadBytesPerDay': dict(sorted(state['uploadBytesPerDay'].items())),
+        'topUsersByStorage': [
+            {'username': username, 'bytes': user['bytes'], 'files': user['files']}
+            for username, user in top if user['bytes'] > 0
+        ]
+    }
+
+def save(s3_client, bucket, state, etag, day):
+    """條件寫入狀態（ETag 不符時拋出 PreconditionFailed），成功後寫入快照"""
+    prune_history(state, day)
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=ANALYTICS_STATE_KEY,
+        Body=json.dumps(state, ensure_ascii=False, separators=(',', ':')),
+        ContentType='application/json',
+        **condition
+    )
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=ANALYTICS_SNAPSHOT_KEY,
+        Body=json.dumps(build_snapshot(state, day), ensure_ascii=False),
+        ContentType='application/json'
+    )
+
+def record_event(s3_client, bucket, event_type, username, size_bytes=0):
+    """寫入一個事件物件（單次 PUT，稍後由 fold_events 彙整）；統計失敗只記錄不影響主要流程"""
+    day = today()
+    # 以時間為前綴，彙整時依鍵值排序即為發生順序
+    key = f"{ANALYTICS_EVENTS_PREFIX}{day}/{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}.json"
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=json.dumps({'type': event_type, 'user': username, 'bytes': size_bytes, 'day': day}, ensure_ascii=False),
+            ContentType='application/json'
+        )
+        return True
+    except Exception as e:
+        print(f"Error recording analytics event {event_type}: {str(e)}")
+        return False
+
+def list_event_keys(s3_client, bucket, limit=None):
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=ANALYTICS_EVENTS_PREFIX):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        if limit is not None and len(keys) >= limit:
+            return sorted(keys)[:limit]
+    return sorted(keys)
+
+def delete_event_keys(s3_client, bucket, keys):
+    for start in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True}
+        )
+
+def fold_events(s3_client, bucket, limit=FOLD_BATCH):
+    """將待處理的事件套用到狀態並重新產生快照，返回套用的事件數
+
+    狀態以條件寫入保存（同時執行的另一次彙整搶先時放棄，事件留待下次）；
+    本次套用的事件鍵值記在狀態的 folded 中，刪除事件前中斷時下次會略過這些事件而不重複計算。
+    """
+    keys = list_event_keys(s3_client, bucket, limit)
+    if not keys:
+        return 0
+    state, etag = load_state(s3_client, bucket)
+    already_folded = set(state.get('folded', []))
+    pending = [key for key in keys if key not in already_folded]
+
+    def load_event(key):
+        try:
+            return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise e
+
+    with ThreadPoolExecutor(max_workers=FOLD_WORKERS) as executor:
+        events = list(executor.map(load_event, pending))
+    for event in events:
+        if event is not None:
+            apply_event(state, event['type'], event['user'], event['day'], event.get('bytes', 0))
+    state['folded'] = pending
+
+    try:
+        save(s3_client, bucket, state, etag, today())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            print("Analytics state changed during fold, leaving events for the next run")
+            return 0
+        raise e
+    delete_event_keys(s3_client, bucket, keys)
+    print(f"Folded {len(pending)} analytics events")
+    return len(pending)
+
+def rebuild(s3_client, bucket, users_index_key, profiles_prefix, files_index_keys):
+    """以現有的用戶索引、個人資料與文件索引重建狀態（每日登入次數只能由最後登入日推估）"""
+    # 只有重建時需要文件索引，登入與註冊 Lambda 不必一併打包 file_index
+    from file_index import load_index, ms_to_datetime
+
+    response = s3_client.get_object(Bucket=bucket, Key=users_index_key)
+    usernames = [user['username'] for user in json.loads(response['Body'].read())['users']]
+
+    def load_profile(username):
+        try:
+            profile = s3_client.get_object(Bucket=bucket, Key=f'{profiles_prefix}{username}.json')
+            return json.loads(profile['Body'].read())
+        except ClientError:
+            return {}
+
+    # 重建前已寫入的事件已反映在現有資料中，重建後刪除
+    event_keys = list_event_keys(s3_client, bucket)
+    state = empty_state()
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for username, profile in zip(usernames, executor.map(load_profile, usernames)):
+            last_login = (profile.get('lastLogin') or '')[:10] or None
+            state['users'][username] = {'lastActive': last_login, 'bytes': 0, 'files': 0}
+            if last_login:
+                state['loginsPerDay'][last_login] = state['loginsPerDay'].get(last_login, 0) + 1
+
+    for files_index_key in files_index_keys:
+        for username, entries in load_index(s3_client, bucket, files_index_key).items():
+            user = state['users'].setdefault(username, {'lastActive': None, 'bytes': 0, 'files': 0})
+            for entry in entries:
+                # 他人分享的參照不佔用接收者的儲存空間
+                if entry.owner:
+                    continue
+                day = ms_to_datetime(entry.uploaded_at).strftime('%Y-%m-%d')
+                user['bytes'] += entry.size_bytes
+                user['files'] += 1
+                if not user['lastActive'] or day > user['lastActive']:
+                    user['lastActive'] = day
+                state['uploadsPerDay'][day] = state['uploadsPerDay'].get(day, 0) + 1
+                state['uploadBytesPerDay'][day] = state['uploadBytesPerDay'].get(day, 0) + entry.size_bytes
+
+    _, etag = load_state(s3_client, bucket)
+    save(s3_client, bucket, state, etag, today())
+    delete_event_keys(s3_client, bucket, event_keys)
+    return state
+
+if __name__ == '__main__':
+    import os
+    import boto3
+    from key_layout import all_index_keys
+
+    if sys.argv[1:] not in (['rebuild'], ['fold']):
+        print(__doc__)
+        sys.exit(1)
+    client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+    bucket = os.environ.get('BUCKET_NAME', 'awslambda0521')
+    if sys.argv[1] == 'fold':
+        while fold_events(client, bucket) == FOLD_BATCH:
+            pass
+        sys.exit(0)
+    rebuilt = rebuild(client, bucket, 'users/users.json', 'users/profiles/', all_index_keys())
+    print(f"Rebuilt analytics for {len(rebuilt['users'])} users")
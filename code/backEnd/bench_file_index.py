@@ -0,0 +1,97 @@
+"""比較舊版 JSON 索引與精簡欄式索引的讀寫時間與大小
+
+用法: python bench_file_index.py [--users 100] [--changes 200] [筆數 ...]（預設 1000 100000 1000000）
+
+精簡格式與實際寫入的索引相同，包含每位用戶的版本與變更紀錄：
+每筆文件記錄一次新增，另為每位用戶記錄 --changes 次變更（分享、重新命名等），
+紀錄長度由 FileIndex 依上限截斷。
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from file_index import FileEntry, FileIndex, decode_index, encode_index, format_file_size, ms_to_datetime, to_iso
+
+BUCKET = 'awslambda0521'
+
+def build_entries(count, users, changes):
+    """產生 count 筆平均分散於 users 位用戶的文件記錄與變更紀錄"""
+    files_index = FileIndex()
+    base_ms = 1747927845123
+    for i in range(count):
+        username = f'user{i % users}'
+        unique_name = f'photo{i}_20250522_153045.jpg'
+        entry = FileEntry(
+            name=f'photo{i}.jpg',
+            s3_key=f'files/{username}/{unique_name}',
+            size_bytes=100000 + i,
+            uploaded_at=base_ms + i * 1000,
+            content_type='image/jpeg'
+        )
+        files_index.setdefault(username, []).append(entry)
+        files_index.record_change(username, 'add', entry.s3_key)
+    for username, entries in files_index.items():
+        for i in range(changes):
+            s3_key = entries[i % len(entries)].s3_key
+            files_index.record_change(username, 'rename', s3_key, s3_key)
+    return files_index
+
+def to_legacy(files_index):
+    """轉換為舊版索引結構（與改版前 upload_file_to_s3 寫入的欄位相同）"""
+    legacy = {}
+    for username, entries in files_index.items():
+        legacy[username] = [{
+            'name': entry.name,
+            'uniqueName': entry.unique_name,
+            's3Key': entry.s3_key,
+            'url': f'https://{BUCKET}.s3.amazonaws.com/{entry.s3_key}',
+            'size': format_file_size(entry.size_bytes),
+            'uploadDate': ms_to_datetime(entry.uploaded_at).strftime('%Y-%m-%d'),
+            'uploadTime': to_iso(ms_to_datetime(entry.uploaded_at)),
+            'type': entry.content_type
+        } for entry in entries]
+    return legacy
+
+def timed(func, *args):
+    gc.collect()
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def memory_of(func, *args):
+    """解析後常駐記憶體（tracemalloc 量測，不含暫存峰值）"""
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+def bench(count, users, changes):
+    files_index = build_entries(count, users, changes)
+    legacy = to_legacy(files_index)
+
+    legacy_raw, legacy_save = timed(lambda: json.dumps(legacy, ensure_ascii=False).encode('utf-8'))
+    _, legacy_load = timed(json.loads, legacy_raw)
+    compact_raw, compact_save = timed(encode_index, files_index)
+    _, compact_load = timed(decode_index, compact_raw)
+
+    legacy_mem = memory_of(json.loads, legacy_raw)
+    compact_mem = memory_of(decode_index, compact_raw)
+
+    print(f'{count:>9} entries | legacy  : save {legacy_save:7.3f}s  load {legacy_load:7.3f}s  '
+          f'size {len(legacy_raw) / 1e6:8.2f} MB  memory {legacy_mem / 1e6:8.1f} MB')
+    print(f'{"":>9}         | compact : save {compact_save:7.3f}s  load {compact_load:7.3f}s  '
+          f'size {len(compact_raw) / 1e6:8.2f} MB  memory {compact_mem / 1e6:8.1f} MB')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='文件索引格式效能比較')
+    parser.add_argument('counts', type=int, nargs='*', default=[1000, 100000, 1000000], help='文件記錄筆數')
+    parser.add_argument('--users', type=int, default=100, help='用戶數')
+    parser.add_argument('--changes', type=int, default=200, help='每位用戶在新增之外的變更次數')
+    args = parser.parse_args()
+    for count in args.counts:
+        bench(count, args.users, args.changes)
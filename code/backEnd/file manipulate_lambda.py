@@ -3,26 +3,72 @@ import base64
 import boto3
 import re
 import os
+import io
+import time
+import hashlib
+import uuid
+import threading
+import gzip
+import zipfile
+from urllib.parse import quote
+from collections import OrderedDict
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
+from file_index import (
+    FileEntry, ORIGINAL_NAME_METADATA, PUBLIC_URL_TEMPLATE, load_index, load_index_if_changed, update_index,
+    format_file_size, now_ms
+)
+from analytics import record_event
+from key_layout import object_key, user_prefix, index_key
 
-# S3 存储桶配置
-output_bucket = 'awslambda0521'
-s3_client = boto3.client('s3')
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-# 文件存储路径配置
-FILES_PREFIX = 'files/'
-USER_FILES_INDEX = 'files/user_files_index.json'
+# S3 存储桶配置（S3_ENDPOINT_URL 可指向本地 S3 相容服務，見 local_server.py）
+output_bucket = os.environ.get('BUCKET_NAME', 'awslambda0521')
+s3_client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+# Lambda client 只在非同步打包時建立（需要區域設定，local_server 部署可能沒有）
+lambda_client = None
+
+# 文件與索引的存放位置由 key_layout 決定（環境變數 KEY_LAYOUT）
+
+# 啟用 S3 事件維護索引（s3_event_lambda）時，上傳不再同步更新索引
+INDEX_VIA_S3_EVENTS = os.environ.get('INDEX_VIA_S3_EVENTS', 'false').lower() == 'true'
+
+# 單一請求內並行 S3 操作的執行緒池（warm container 之間共用，boto3 client 為執行緒安全）
+MAX_IO_WORKERS = int(os.environ.get('MAX_IO_WORKERS', '8'))
+io_executor = ThreadPoolExecutor(max_workers=MAX_IO_WORKERS)
 
 # CORS 配置
 CORS_HEADERS = {
     'Access-Control-Allow-Origin': '*',
-    'Access-Control-Allow-Headers': 'Content-Type',
-    'Access-Control-Allow-Methods': 'POST, GET, DELETE, OPTIONS'
+    'Access-Control-Allow-Headers': 'Content-Type, If-None-Match, Idempotency-Key',
+    'Access-Control-Allow-Methods': 'POST, GET, PUT, DELETE, OPTIONS',
+    'Access-Control-Expose-Headers': 'ETag, Idempotent-Replayed, Retry-After'
 }
 
+# 文件列表快取（warm container 內有效）：
+# 索引以 S3 ETag 條件式讀取，各索引版本已序列化與壓縮的回應主體以 LRU 保留
+LISTING_CACHE_SIZE = int(os.environ.get('LISTING_CACHE_SIZE', '256'))
+MIN_COMPRESS_BYTES = 1024
+# 壓縮的回應以 base64 返回：HTTP API（payload 2.0）一律解碼；REST API 需設定二進位媒體類型（如 */*），
+# 否則瀏覽器收到標示為 gzip 的 base64 文字，因此只在設定此環境變數時壓縮 REST API 的回應
+REST_BINARY_RESPONSES = os.environ.get('REST_BINARY_RESPONSES', 'false').lower() == 'true'
+listing_index_cache = {}  # 索引鍵值 -> (ETag, 已解析的索引)
+listing_body_cache = OrderedDict()
+
 def lambda_handler(event, context):
     print("Received event:", json.dumps(event))
+    # 非同步打包任務（由 handle_archive 以 Event 方式呼叫自身觸發）
+    if 'archiveJob' in event:
+        return run_archive_job(event['archiveJob'])
+    
+    # 寫出逾時未寫出的存取計數（流量變低的 container 不會一直保留計數；於背景執行）
+    flush_stale_access()
+    
     # 處理 OPTIONS 請求 (CORS preflight)
     http_method = (
         event.get('httpMethod') or  # v1.0
@@ -38,43 +84,66 @@ def lambda_handler(event, context):
         }
     
     try:
-        # 檢查請求類型
-        content_type = ""
-        if 'headers' in event:
-            headers = event['headers']
-            content_type = headers.get('content-type', headers.get('Content-Type', ''))
-        
-        # 處理 GET 請求 - 獲取用戶文件列表
-        if http_method.upper() == 'GET':
-            return handle_get_files(event)
-        
-        # 處理 DELETE 請求 - 刪除文件
-        elif http_method.upper() == 'DELETE':
-            return handle_delete_file(event)
-        
-        # 處理 PUT 請求 - 重新命名文件
-        elif http_method.upper() == 'PUT':
-            return handle_rename_file(event)
-        
-        # 處理 POST 請求 - 上傳文件
-        elif http_method.upper() == 'POST':
-            if 'multipart/form-data' in content_type:
-                return handle_multipart_upload(event, content_type)
-            elif 'application/json' in content_type:
-                return handle_json_upload(event)
-            else:
-                return response(400, 'Unsupported content type')
+        # 帶有 Idempotency-Key 的寫入請求：重送時直接返回第一次的結果，不重複執行 S3 寫入
+        idempotency_key = get_header(event, 'Idempotency-Key')
+        if idempotency_key and http_method.upper() in IDEMPOTENT_METHODS:
+            return handle_idempotent(
+                idempotency_key, event, http_method,
+                lambda: route_request(event, context, http_method)
+            )
         
-        else:
-            print(f"Unsupported method received: {http_method}")
-            return response(400, f'Unsupported HTTP method: {http_method}')
+        return route_request(event, context, http_method)
         
     except Exception as e:
         print(f"Error: {str(e)}")
         return response(500, f'Internal server error: {str(e)}')
 
+def route_request(event, context, http_method):
+    """依 HTTP 方法與內容類型分派請求"""
+    # 檢查請求類型
+    content_type = ""
+    if 'headers' in event:
+        headers = event['headers']
+        content_type = headers.get('content-type', headers.get('Content-Type', ''))
+    
+    # 處理 GET 請求 - 獲取用戶文件列表
+    if http_method.upper() == 'GET':
+        return handle_get_files(event)
+    
+    # 處理 DELETE 請求 - 刪除文件
+    elif http_method.upper() == 'DELETE':
+        return handle_delete_file(event)
+    
+    # 處理 PUT 請求 - 重新命名文件
+    elif http_method.upper() == 'PUT':
+        return handle_rename_file(event)
+    
+    # 處理 POST 請求 - 上傳文件
+    elif http_method.upper() == 'POST':
+        if 'multipart/form-data' in content_type:
+            return handle_multipart_upload(event, content_type)
+        elif 'application/json' in content_type:
+            request_body = parse_json_body(event)
+            if request_body and request_body.get('action') == 'archive':
+                return handle_archive(request_body, context)
+            if request_body and request_body.get('action') == 'archiveStatus':
+                return handle_archive_status(request_body)
+            if request_body and request_body.get('action') == 'access':
+                return handle_access(request_body)
+            if request_body and request_body.get('action') == 'share':
+                return handle_share(request_body)
+            if request_body and request_body.get('action') == 'unshare':
+                return handle_unshare(request_body)
+            return handle_json_upload(event)
+        else:
+            return response(400, 'Unsupported content type')
+    
+    else:
+        print(f"Unsupported method received: {http_method}")
+        return response(400, f'Unsupported HTTP method: {http_method}')
+
 def handle_get_files(event):
-    """處理獲取用戶文件列表的請求"""
+    """處理獲取用戶文件列表的請求（支援 ETag / If-None-Match、gzip/br 壓縮與 since 增量查詢）"""
     try:
         # 從查詢參數獲取用戶名
         query_params = event.get('queryStringParameters', {}) or {}
@@ -83,22 +152,156 @@ def handle_get_files(event):
         if not username:
             return response(400, 'Missing username parameter')
         
-        # 獲取用戶的文件列表
-        user_files = get_user_files(username)
+        since = query_params.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return response(400, 'Invalid since parameter')
         
+        # 以用戶版本作為 ETag，客戶端版本相同時直接返回 304
+        files_index = get_listing_index(username)
+        user_version = files_index.user_version(username)
+        etag = f'W/"{user_version}"'
+        listing_headers = {
+            **CORS_HEADERS,
+            'ETag': etag,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        
+        # 列表頁以原始物件作為縮圖，每次顯示列表（含 304）即讀取所有文件，計入存取供冷資料分層判斷
+        record_access([entry.s3_key for entry in files_index.get(username, [])])
+        
+        if etag_matches(get_header(event, 'If-None-Match'), etag):
+            return {
+                'statusCode': 304,
+                'headers': listing_headers,
+                'body': ''
+            }
+        
+        # 同一索引版本與編碼的回應主體只序列化、壓縮一次
+        encoding = choose_encoding(get_header(event, 'Accept-Encoding')) if binary_responses_allowed(event) else None
+        cache_key = (username, user_version, since, encoding)
+        cached = listing_body_cache.get(cache_key)
+        if cached is None:
+            body = json.dumps(
+                build_listing(files_index, username, since), ensure_ascii=False
+            )
+            cached = encode_listing_body(body, encoding)
+            listing_body_cache[cache_key] = cached
+            if len(listing_body_cache) > LISTING_CACHE_SIZE:
+                listing_body_cache.popitem(last=False)
+        else:
+            listing_body_cache.move_to_end(cache_key)
+        
+        body, used_encoding = cached
+        if used_encoding:
+            return {
+                'statusCode': 200,
+                'headers': {**listing_headers, 'Content-Encoding': used_encoding},
+                'body': body,
+                'isBase64Encoded': True
+            }
         return {
             'statusCode': 200,
-            'headers': CORS_HEADERS,
-            'body': json.dumps({
-                'files': user_files,
-                'count': len(user_files)
-            }, ensure_ascii=False)
+            'headers': listing_headers,
+            'body': body
         }
         
     except Exception as e:
         print(f"Error getting files: {str(e)}")
         return response(500, 'Failed to get files')
 
+def build_listing(files_index, username, since=None):
+    """建立列表回應：提供 since 且變更紀錄足夠時只返回增量，否則返回完整列表"""
+    user_files = files_index.get(username, [])
+    user_version = files_index.user_version(username)
+    changes = None
+    if since is not None:
+        changes = files_index.changes_since(username, since)
+    
+    if changes is None:
+        return {
+            'files': [entry.to_response(output_bucket) for entry in user_files],
+            'count': len(user_files),
+            'version': user_version,
+            'full': True
+        }
+    
+    added, removed, renamed = changes
+    wanted = set(added) | set(renamed.values())
+    current = {entry.s3_key: entry for entry in user_files if entry.s3_key in wanted}
+    return {
+        'added': [current[key].to_response(output_bucket) for key in added if key in current],
+        'removed': removed,
+        'renamed': [
+            {'from': old_key, 'file': current[new_key].to_response(output_bucket)}
+            for old_key, new_key in renamed.items() if new_key in current
+        ],
+        'count': len(user_files),
+        'version': user_version,
+        'since': since,
+        'full': False
+    }
+
+def get_listing_index(username):
+    """以條件式 GET 取得用戶所在的索引，S3 上的索引未變更時沿用 warm container 中已解析的索引（唯讀）"""
+    key = index_key(username)
+    cached_etag, cached_index = listing_index_cache.get(key, (None, None))
+    files_index, etag = load_index_if_changed(s3_client, output_bucket, key, cached_etag)
+    if files_index is None:
+        return cached_index
+    listing_index_cache[key] = (etag, files_index)
+    return files_index
+
+def get_header(event, name):
+    """不分大小寫讀取請求標頭（HTTP API v2.0 會將標頭轉為小寫）"""
+    headers = event.get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def etag_matches(if_none_match, etag):
+    """比對 If-None-Match（可能包含多個以逗號分隔的 ETag，使用弱比較）"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or any(tag.removeprefix('W/') == etag.removeprefix('W/') for tag in candidates)
+
+def binary_responses_allowed(event):
+    """API Gateway 是否會將 isBase64Encoded 的回應解碼為二進位內容"""
+    return event.get('version') == '2.0' or REST_BINARY_RESPONSES
+
+def choose_encoding(accept_encoding):
+    """依 Accept-Encoding 選擇壓縮方式，br 優先（需有 brotli 模組）"""
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    if brotli is not None and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+def encode_listing_body(body, encoding):
+    """壓縮回應主體，返回 (body, 實際使用的編碼)；內容過小時不壓縮"""
+    raw = body.encode('utf-8')
+    if not encoding or len(raw) < MIN_COMPRESS_BYTES:
+        return body, None
+    if encoding == 'br':
+        compressed = brotli.compress(raw)
+    else:
+        compressed = gzip.compress(raw)
+    return base64.b64encode(compressed).decode('ascii'), encoding
+
 def handle_delete_file(event):
     """處理刪除文件的請求"""
     try:
@@ -134,49 +337,10 @@ def handle_multipart_upload(event, content_type):
             body_binary = base64.b64decode(event['body'])
             
             # 解析 multipart 數據
-            boundary_match = re.search(r'boundary=([^;]+)', content_type)
-            if not boundary_match:
+            fields = parse_multipart_form(body_binary, content_type)
+            if fields is None:
                 return response(400, 'Could not find multipart boundary')
-            
-            boundary = boundary_match.group(1)
-            boundary_bytes = f'--{boundary}'.encode('utf-8')
-            
-            # 分解 multipart 數據
-            parts = body_binary.split(boundary_bytes)
-            
-            file_content = None
-            filename = None
-            username = None
-            
-            # 解析每個部分
-            for part in parts:
-                if len(part) < 10:
-                    continue
-                
-                part_str = part.decode('utf-8', errors='replace')
-                
-                # 檢查是否是文件部分
-                if 'Content-Disposition' in part_str and 'filename=' in part_str:
-                    filename_match = re.search(r'filename="([^"]+)"', part_str)
-                    if filename_match:
-                        filename = filename_match.group(1)
-                    
-                    headers_end = part.find(b'\r\n\r\n')
-                    if headers_end > 0:
-                        file_content = part[headers_end + 4:]
-                        if file_content.endswith(b'--\r\n'):
-                            file_content = file_content[:-4]
-                        if file_content.endswith(b'\r\n'):
-                            file_content = file_content[:-2]
-                
-                # 檢查是否是用戶名部分
-                elif 'Content-Disposition' in part_str and 'name="username"' in part_str:
-                    headers_end = part.find(b'\r\n\r\n')
-                    if headers_end > 0:
-                        username_content = part[headers_end + 4:]
-                        if username_content.endswith(b'\r\n'):
-                            username_content = username_content[:-2]
-                        username = username_content.decode('utf-8').strip()
+            username, filename, file_content = fields
             
             if file_content is not None and filename and username:
                 # 上傳文件
@@ -190,6 +354,64 @@ def handle_multipart_upload(event, content_type):
         print(f"Error in multipart upload: {str(e)}")
         return response(500, f'Upload failed: {str(e)}')
 
+def parse_multipart_form(body_binary, content_type):
+    """解析 multipart 主體，返回 (username, filename, file_content)；找不到 boundary 時返回 None"""
+    boundary_match = re.search(r'boundary=([^;]+)', content_type)
+    if not boundary_match:
+        return None
+    
+    boundary = boundary_match.group(1)
+    boundary_bytes = f'--{boundary}'.encode('utf-8')
+    
+    # 分解 multipart 數據
+    parts = body_binary.split(boundary_bytes)
+    
+    file_content = None
+    filename = None
+    username = None
+    
+    # 解析每個部分
+    for part in parts:
+        if len(part) < 10:
+            continue
+        
+        part_str = part.decode('utf-8', errors='replace')
+        
+        # 檢查是否是文件部分
+        if 'Content-Disposition' in part_str and 'filename=' in part_str:
+            filename_match = re.search(r'filename="([^"]+)"', part_str)
+            if filename_match:
+                filename = filename_match.group(1)
+            
+            headers_end = part.find(b'\r\n\r\n')
+            if headers_end > 0:
+                file_content = part[headers_end + 4:]
+                if file_content.endswith(b'--\r\n'):
+                    file_content = file_content[:-4]
+                if file_content.endswith(b'\r\n'):
+                    file_content = file_content[:-2]
+        
+        # 檢查是否是用戶名部分
+        elif 'Content-Disposition' in part_str and 'name="username"' in part_str:
+            headers_end = part.find(b'\r\n\r\n')
+            if headers_end > 0:
+                username_content = part[headers_end + 4:]
+                if username_content.endswith(b'\r\n'):
+                    username_content = username_content[:-2]
+                username = username_content.decode('utf-8').strip()
+    
+    return username, filename, file_content
+
+def parse_json_body(event):
+    """解析 JSON 請求主體，無法解析時返回 None"""
+    body = event.get('body')
+    if isinstance(body, str):
+        try:
+            return json.loads(body)
+        except json.JSONDecodeError:
+            return None
+    return body if isinstance(body, dict) else None
+
 def handle_json_upload(event):
     """處理 JSON 格式的上傳"""
     try:
@@ -221,9 +443,6 @@ def handle_json_upload(event):
 def upload_file_to_s3(username, original_filename, file_content):
     """上傳文件到 S3 並更新用戶文件索引"""
     try:
-        # 確保用戶目錄存在
-        ensure_user_directory(username)
-        
         # 清理文件名以確保安全
         safe_filename = re.sub(r'[^\w\.-]', '_', original_filename)
         
@@ -233,40 +452,55 @@ def upload_file_to_s3(username, original_filename, file_content):
         unique_filename = f"{name}_{timestamp}{ext}"
         
         # 構建 S3 鍵值（路徑）
-        s3_key = f"{FILES_PREFIX}{username}/{unique_filename}"
+        s3_key = object_key(username, unique_filename)
         
         # 根據文件擴展名確定 Content-Type
         content_type = get_content_type(safe_filename)
         
-        # 上傳到 S3
-        s3_client.put_object(
+        # 目錄標記、文件上傳與索引讀取互不相依，並行執行
+        directory_future = io_executor.submit(ensure_user_directory, username)
+        index_future = None
+        if not INDEX_VIA_S3_EVENTS:
+            index_future = io_executor.submit(load_files_index, username)
+        put_future = io_executor.submit(
+            s3_client.put_object,
             Bucket=output_bucket,
             Key=s3_key,
             Body=file_content,
             ACL='public-read',
-            ContentType=content_type
+            ContentType=content_type,
+            Metadata={ORIGINAL_NAME_METADATA: quote(original_filename)}
         )
         
+        # 上傳到 S3
+        put_future.result()
+        directory_future.result()
+        
         # 獲取文件大小
         file_size = len(file_content)
         file_size_str = format_file_size(file_size)
         
         # 構建文件 URL
-        s3_url = f'https://{output_bucket}.s3.amazonaws.com/{s3_key}'
-        
-        # 更新用戶文件索引
-        file_info = {
-            'name': original_filename,
-            'uniqueName': unique_filename,
-            's3Key': s3_key,
-            'url': s3_url,
-            'size': file_size_str,
-            'uploadDate': datetime.now().strftime('%Y-%m-%d'),
-            'uploadTime': datetime.now().isoformat() + 'Z',
-            'type': content_type
-        }
+        s3_url = PUBLIC_URL_TEMPLATE.format(bucket=output_bucket, key=s3_key)
+        
+        # 更新用戶文件索引（url 與格式化大小於回應時推導，不存入索引）
+        file_entry = FileEntry(
+            name=original_filename,
+            s3_key=s3_key,
+            size_bytes=file_size,
+            uploaded_at=now_ms(),
+            content_type=content_type
+        )
+        
+        # 記錄管理員統計事件與更新索引並行執行
+        analytics_future = io_executor.submit(
+            record_event, s3_client, output_bucket, 'upload', username, file_size
+        )
         
-        add_file_to_index(username, file_info)
+        # 由 S3 事件維護索引時，索引記錄稍後由 s3_event_lambda 寫入
+        if index_future is not None:
+            add_file_to_index(username, file_entry, files_index=index_future.result())
+        analytics_future.result()
         
         return {
             'statusCode': 200,
@@ -283,113 +517,121 @@ def upload_file_to_s3(username, original_filename, file_content):
         print(f"Error uploading to S3: {str(e)}")
         return response(500, f'Upload to S3 failed: {str(e)}')
 
-def get_user_files(username):
-    """獲取用戶的文件列表"""
-    try:
-        # 確保索引文件存在
-        ensure_files_index()
-        
-        # 從 S3 獲取用戶文件索引
-        try:
-            response = s3_client.get_object(Bucket=output_bucket, Key=USER_FILES_INDEX)
-            content = response['Body'].read().decode('utf-8')
-            files_index = json.loads(content)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                ensure_files_index()
-                return []
-            else:
-                raise e
-        
-        # 返回指定用戶的文件
-        return files_index.get(username, [])
-        
-    except Exception as e:
-        print(f"Error getting user files: {str(e)}")
-        return []
+def load_files_index(username):
+    """從 S3 讀取存放該用戶記錄的文件索引（精簡格式或舊版 JSON），索引不存在時返回空索引"""
+    return load_index(s3_client, output_bucket, index_key(username))
+
+def load_user_indexes(usernames, loaded=None):
+    """讀取多位用戶所在的索引，返回 {username: FileIndex}
+
+    位於同一索引的用戶共用同一個物件（同一索引只讀取一次）；loaded 為已讀取的 {索引鍵值: FileIndex}。
+    """
+    loaded = dict(loaded or {})
+    keys = {username: index_key(username) for username in usernames}
+    futures = {
+        key: io_executor.submit(load_index, s3_client, output_bucket, key)
+        for key in set(keys.values()) if key not in loaded
+    }
+    for key, future in futures.items():
+        loaded[key] = future.result()
+    return {username: loaded[key] for username, key in keys.items()}
 
-def add_file_to_index(username, file_info):
-    """將文件信息添加到用戶文件索引"""
+def update_user_indexes(changes, loaded=None):
+    """以條件寫入依序更新多位用戶所在的索引，changes 為 [(username, mutate), ...]
+
+    同一索引的變更合併為一次讀取-修改-寫入，各索引依 changes 中首次出現的順序更新；
+    其他寫入者搶先時重新讀取該索引並重新套用其所有 mutate（見 file_index.update_index），
+    因此 mutate 需依鍵值重新尋找記錄並可重複執行。loaded 為剛讀取的 {username: FileIndex}。
+    只在請求執行緒上呼叫：在 io_executor 的工作中再提交並等待會佔滿執行緒池而死結。
+    """
+    by_key = {}
+    for username, mutate in changes:
+        by_key.setdefault(index_key(username), []).append(mutate)
+    first_loads = {index_key(username): files_index for username, files_index in (loaded or {}).items()}
+    for key, mutates in by_key.items():
+        # 以清單收集結果，確保每個 mutate 都被執行
+        update_index(
+            s3_client, output_bucket, key,
+            lambda files_index, mutates=mutates: any([mutate(files_index) for mutate in mutates]),
+            first_loads.get(key)
+        )
+
+def add_file_to_index(username, file_entry, files_index=None):
+    """將文件信息添加到用戶文件索引（可傳入已並行讀取的索引以省去一次 GET）"""
     try:
-        # 確保索引文件存在
-        ensure_files_index()
-        
-        # 讀取現有索引
-        try:
-            response = s3_client.get_object(Bucket=output_bucket, Key=USER_FILES_INDEX)
-            content = response['Body'].read().decode('utf-8')
-            files_index = json.loads(content)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                files_index = {}
-            else:
-                raise e
-        
-        # 初始化用戶文件列表
-        if username not in files_index:
-            files_index[username] = []
-        
-        # 添加新文件信息
-        files_index[username].append(file_info)
+        def add_entry(files_index):
+            user_files = files_index.get(username, [])
+            # 由 S3 事件維護索引時記錄可能已先被加入
+            if any(entry.s3_key == file_entry.s3_key for entry in user_files):
+                return False
+            files_index[username] = user_files + [file_entry]
+            files_index.record_change(username, 'add', file_entry.s3_key)
+            return True
         
-        # 保存更新的索引
-        s3_client.put_object(
-            Bucket=output_bucket,
-            Key=USER_FILES_INDEX,
-            Body=json.dumps(files_index, ensure_ascii=False),
-            ContentType='application/json'
-        )
+        update_index(s3_client, output_bucket, index_key(username), add_entry, files_index)
         
-        print(f"Added file to index for user {username}: {file_info['name']}")
+        print(f"Added file to index for user {username}: {file_entry.name}")
         
     except Exception as e:
         print(f"Error updating file index: {str(e)}")
         raise e
 
+def remove_entry(files_index, username, s3_key, owner=None):
+    """移除用戶的文件記錄（owner 為 None 時為自己擁有的文件，否則為該擁有者分享的參照）"""
+    user_files = files_index.get(username, [])
+    entry = next((f for f in user_files if f.s3_key == s3_key and f.owner == owner), None)
+    if entry is None:
+        return False
+    user_files.remove(entry)
+    files_index.record_change(username, 'remove', s3_key)
+    return True
+
 def delete_user_file(username, filename):
     """刪除用戶的文件"""
     try:
         # 讀取文件索引
-        try:
-            response = s3_client.get_object(Bucket=output_bucket, Key=USER_FILES_INDEX)
-            content = response['Body'].read().decode('utf-8')
-            files_index = json.loads(content)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                return False
-            else:
-                raise e
+        files_index = load_files_index(username)
         
         # 查找要刪除的文件
-        user_files = files_index.get(username, [])
         file_to_delete = None
-        file_index = -1
-        
-        for i, file_info in enumerate(user_files):
-            if file_info['name'] == filename or file_info['uniqueName'] == filename:
-                file_to_delete = file_info
-                file_index = i
+        for file_entry in files_index.get(username, []):
+            if file_entry.matches(filename):
+                file_to_delete = file_entry
                 break
         
         if file_to_delete is None:
             return False
         
-        # 從 S3 刪除文件
-        try:
-            s3_client.delete_object(Bucket=output_bucket, Key=file_to_delete['s3Key'])
-        except Exception as e:
-            print(f"Error deleting file from S3: {str(e)}")
+        s3_key = file_to_delete.s3_key
+        owner = file_to_delete.owner
         
-        # 從索引中移除文件
-        user_files.pop(file_index)
+        # 他人分享的參照：只移除參照並更新擁有者的分享清單，物件屬於擁有者不刪除
+        if owner:
+            update_user_indexes([
+                (username, lambda files_index: remove_entry(files_index, username, s3_key, owner)),
+                (owner, lambda files_index: remove_recipient(files_index, owner, s3_key, username))
+            ], loaded={username: files_index})
+            print(f"Removed shared reference for user {username}: {filename}")
+            return True
         
-        # 保存更新的索引
-        s3_client.put_object(
-            Bucket=output_bucket,
-            Key=USER_FILES_INDEX,
-            Body=json.dumps(files_index, ensure_ascii=False),
-            ContentType='application/json'
+        # 從 S3 刪除文件與更新索引互不相依，並行執行；擁有者刪除文件時一併移除所有接收者的參照
+        delete_future = io_executor.submit(s3_client.delete_object, Bucket=output_bucket, Key=s3_key)
+        analytics_future = io_executor.submit(
+            record_event, s3_client, output_bucket, 'delete', username, file_to_delete.size_bytes
         )
+        update_user_indexes([
+            (username, lambda files_index: remove_entry(files_index, username, s3_key)),
+            *[
+                (recipient, lambda files_index, recipient=recipient: drop_reference(files_index, recipient, username, s3_key))
+                for recipient in file_to_delete.shared_with or []
+            ]
+        ], loaded={username: files_index})
+        
+        try:
+            delete_future.result()
+        except Exception as e:
+            print(f"Error deleting file from S3: {str(e)}")
+        analytics_future.result()
         
         print(f"Deleted file for user {username}: {filename}")
         return True
@@ -416,7 +658,7 @@ def ensure_user_directory(username):
     """確保用戶目錄存在（在 S3 中創建目錄標記）"""
     try:
         # 在 S3 中，我們通過創建一個空的 "目錄標記" 對象來表示目錄
-        directory_key = f"{FILES_PREFIX}{username}/"
+        directory_key = user_prefix(username)
         
         # 檢查目錄是否已存在
         try:
@@ -439,45 +681,6 @@ def ensure_user_directory(username):
         # 即使目錄創建失敗，我們仍然可以繼續上傳文件
         # S3 會自動創建路徑結構
 
-def ensure_files_index():
-    """確保文件索引存在"""
-    try:
-        # 檢查索引文件是否存在
-        try:
-            s3_client.head_object(Bucket=output_bucket, Key=USER_FILES_INDEX)
-            print("Files index already exists")
-        except ClientError as e:
-            if e.response['Error']['Code'] == '404':
-                # 索引文件不存在，創建空索引
-                empty_index = {}
-                s3_client.put_object(
-                    Bucket=output_bucket,
-                    Key=USER_FILES_INDEX,
-                    Body=json.dumps(empty_index, ensure_ascii=False),
-                    ContentType='application/json'
-                )
-                print("Created empty files index")
-            else:
-                raise e
-                
-    except Exception as e:
-        print(f"Error ensuring files index: {str(e)}")
-        # 如果無法創建索引文件，add_file_to_index 函數會處理這個問題
-
-# 格式化文件大小函式
-def format_file_size(size_bytes):
-    """格式化文件大小"""
-    if size_bytes == 0:
-        return "0 B"
-    
-    size_names = ["B", "KB", "MB", "GB"]
-    i = 0
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes /= 1024.0
-        i += 1
-    
-    return f"{size_bytes:.1f} {size_names[i]}"
-
 def response(status_code, message):
     """標準化響應格式"""
     return {
@@ -535,13 +738,9 @@ def handle_rename_file(event):
         
         # 讀取使用者檔案索引
         try:
-            response_s3 = s3_client.get_object(Bucket=output_bucket, Key=USER_FILES_INDEX)
-            files_index = json.loads(response_s3['Body'].read().decode('utf-8'))
+            files_index = load_files_index(username)
         except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                return response(404, '檔案索引不存在')
-            else:
-                return response(500, f'讀取檔案索引失敗: {str(e)}')
+            return response(500, f'讀取檔案索引失敗: {str(e)}')
         except Exception as e:
             return response(500, f'處理檔案索引時發生錯誤: {str(e)}')
         
@@ -551,46 +750,49 @@ def handle_rename_file(event):
         
         # 尋找目標檔案
         target_file = None
-        target_index = -1
-        for i, f in enumerate(user_files):
-            if f.get('name') == old_name or f.get('uniqueName') == old_name:
+        for f in user_files:
+            if f.matches(old_name):
                 target_file = f
-                target_index = i
                 break
         
         if not target_file:
             return response(404, f'找不到檔案: {old_name}')
         
+        # 分享參照指向他人的物件，只有擁有者可以重新命名
+        if target_file.owner:
+            return response(403, '無法重新命名他人分享的檔案')
+        
         # 檢查新檔名是否已存在
         for f in user_files:
-            if f.get('name') == new_name and f != target_file:
+            if f.name == new_name and f is not target_file:
                 return response(409, f'檔名「{new_name}」已存在，請選擇其他名稱')
         
         # 產生新的唯一檔名
-        original_name, ext = os.path.splitext(target_file.get('name', ''))
+        original_name, ext = os.path.splitext(target_file.name)
         new_ext = os.path.splitext(new_name)[1] or ext  # 保持原副檔名如果新名稱沒有副檔名
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         # 清理檔名，移除特殊字符
         sanitized_new_name = sanitize_filename(new_name)
         new_unique_name = f"{sanitized_new_name}_{timestamp}{new_ext}"
-        new_s3_key = f"{FILES_PREFIX}{username}/{new_unique_name}"
+        new_s3_key = object_key(username, new_unique_name)
+        
+        old_s3_key = target_file.s3_key
+        original_display_name = target_file.name
+        recipients = list(target_file.shared_with or [])
         
         # 執行S3操作
         try:
-            # 複製檔案到新位置
-            copy_source = {
-                'Bucket': output_bucket, 
-                'Key': target_file.get('s3Key', '')
-            }
-            
+            # 複製檔案到新位置（原始檔名 metadata 改為新名稱，S3 事件處理依此建立記錄）
             s3_client.copy_object(
                 Bucket=output_bucket,
-                CopySource=copy_source,
+                CopySource={'Bucket': output_bucket, 'Key': old_s3_key},
                 Key=new_s3_key,
                 ACL='public-read',
-                ContentType=target_file.get('type', 'application/octet-stream'),
-                MetadataDirective='COPY'
+                ContentType=target_file.content_type,
+                StorageClass=target_file.storage_class,
+                Metadata={ORIGINAL_NAME_METADATA: quote(new_name)},
+                MetadataDirective='REPLACE'
             )
             
             # 驗證新檔案是否成功創建
@@ -599,12 +801,6 @@ def handle_rename_file(event):
             except ClientError:
                 return response(500, '新檔案創建失敗')
             
-            # 刪除原始檔案
-            s3_client.delete_object(
-                Bucket=output_bucket, 
-                Key=target_file.get('s3Key', '')
-            )
-            
         except ClientError as e:
             error_code = e.response['Error']['Code']
             if error_code == 'NoSuchKey':
@@ -616,45 +812,81 @@ def handle_rename_file(event):
         except Exception as e:
             return response(500, f'檔案操作時發生未預期錯誤: {str(e)}')
         
-        # 更新檔案索引
-        current_time = datetime.now()
-        files_index[username][target_index].update({
-            'name': new_name,
-            'uniqueName': new_unique_name,
-            's3Key': new_s3_key,
-            'url': f'https://{output_bucket}.s3.amazonaws.com/{new_s3_key}',
-            'lastModified': current_time.strftime('%Y-%m-%d'),
-            'lastModifiedTime': current_time.isoformat() + 'Z'
-        })
+        # 更新檔案索引（衝突重試時依原鍵值重新尋找記錄，期間被刪除則不重新命名）
+        modified_at = now_ms()
+        renamed = {}
         
-        # 儲存更新後的索引
+        def rename_entry(files_index):
+            renamed.clear()
+            user_files = files_index.get(username, [])
+            entry = next((f for f in user_files if f.s3_key == old_s3_key and not f.owner), None)
+            if entry is None:
+                # S3 事件處理已依複製與刪除事件換成新物件的記錄：視為已重新命名
+                entry = next((f for f in user_files if f.s3_key == new_s3_key and not f.owner), None)
+                if entry is None:
+                    return False
+                entry.name = new_name
+                entry.modified_at = modified_at
+                entry.shared_with = entry.shared_with or recipients or None
+                touch_entry(files_index, username, entry)
+                renamed['entry'] = entry
+                return True
+            # S3 事件處理可能已依複製出的新物件加入一筆記錄
+            remove_entry(files_index, username, new_s3_key)
+            entry.name = new_name
+            entry.s3_key = new_s3_key
+            entry.modified_at = modified_at
+            files_index.record_change(username, 'rename', old_s3_key, new_s3_key)
+            renamed['entry'] = entry
+            return True
+        
+        def repoint_reference(files_index, recipient):
+            reference = find_reference(files_index, recipient, username, old_s3_key)
+            if reference is None or 'entry' not in renamed:
+                return False
+            reference.name = new_name
+            reference.s3_key = new_s3_key
+            reference.modified_at = modified_at
+            files_index.record_change(recipient, 'rename', old_s3_key, new_s3_key)
+            return True
+        
+        # 索引寫入成功後才刪除原始檔案：寫入衝突重試期間原始物件仍在，失敗時只需移除新檔案
         try:
-            s3_client.put_object(
-                Bucket=output_bucket,
-                Key=USER_FILES_INDEX,
-                Body=json.dumps(files_index, ensure_ascii=False, indent=2),
-                ContentType='application/json'
-            )
+            update_user_indexes([
+                (username, rename_entry),
+                *[
+                    (recipient, lambda files_index, recipient=recipient: repoint_reference(files_index, recipient))
+                    for recipient in recipients
+                ]
+            ], loaded={username: files_index})
         except Exception as e:
-            # 如果索引更新失敗，嘗試回滾
+            # 擁有者的索引已指向新檔案（接收者的索引寫入失敗）時保留兩個物件，否則移除新檔案
             try:
-                s3_client.delete_object(Bucket=output_bucket, Key=new_s3_key)
-                s3_client.copy_object(
-                    Bucket=output_bucket,
-                    CopySource=copy_source,
-                    Key=target_file.get('s3Key', ''),
-                    ACL='public-read',
-                    ContentType=target_file.get('type', 'application/octet-stream')
-                )
-            except:
-                pass  # 回滾失敗，記錄錯誤但不影響回應
+                current = load_files_index(username).get(username, [])
+                if any(f.s3_key == new_s3_key and not f.owner for f in current):
+                    print(f"接收者索引更新失敗，保留原始檔案 {old_s3_key}: {str(e)}")
+                else:
+                    s3_client.delete_object(Bucket=output_bucket, Key=new_s3_key)
+            except Exception as rollback_error:
+                print(f"回滾失敗: {str(rollback_error)}")
             
             return response(500, f'更新檔案索引失敗: {str(e)}')
         
+        # 複製期間檔案已被刪除：移除複製出的新檔案
+        if 'entry' not in renamed:
+            s3_client.delete_object(Bucket=output_bucket, Key=new_s3_key)
+            return response(404, f'找不到檔案: {old_name}')
+        
+        try:
+            s3_client.delete_object(Bucket=output_bucket, Key=old_s3_key)
+        except Exception as e:
+            # 原始檔案殘留不影響重新命名結果，僅記錄
+            print(f"刪除原始檔案失敗: {str(e)}")
+        
         return response(200, '檔案重新命名成功', {
             'oldName': old_name,
             'newName': new_name,
-            'newUrl': f'https://{output_bucket}.s3.amazonaws.com/{new_s3_key}'
+            'newUrl': PUBLIC_URL_TEMPLATE.format(bucket=output_bucket, key=new_s3_key)
         })
         
     except NoCredentialsError:
@@ -716,3 +948,622 @@ def response(status_code, message, data=None):
         },
         'body': json.dumps(body, ensure_ascii=False)
     }
+
+# 新增：將多個文件打包為 ZIP 下載
+# 以 multipart upload 串流寫入 S3，記憶體用量與壓縮檔大小無關
+ARCHIVES_PREFIX = 'archives/'
+ARCHIVE_PART_SIZE = 8 * 1024 * 1024          # multipart 分段大小（S3 最小 5 MB）
+ARCHIVE_READ_CHUNK = 1024 * 1024
+ARCHIVE_PREFETCH = int(os.environ.get('ARCHIVE_PREFETCH', '4'))      # 預先開啟的來源物件數
+ARCHIVE_UPLOADS_IN_FLIGHT = 2                 # 同時上傳中的分段數（記憶體上限約為此值 + 1 個分段）
+ARCHIVE_SYNC_BYTES = int(os.environ.get('ARCHIVE_SYNC_BYTES', str(200 * 1024 * 1024)))
+ARCHIVE_URL_EXPIRES = int(os.environ.get('ARCHIVE_URL_EXPIRES', '86400'))
+archive_executor = ThreadPoolExecutor(max_workers=ARCHIVE_PREFETCH + ARCHIVE_UPLOADS_IN_FLIGHT)
+
+class MultipartUploadWriter(io.RawIOBase):
+    """只寫、不可 seek 的檔案物件，累積滿一個分段即以 S3 multipart upload 上傳"""
+
+    def __init__(self, key, content_type='application/zip'):
+        super().__init__()
+        self.key = key
+        self.upload_id = s3_client.create_multipart_upload(
+            Bucket=output_bucket, Key=key, ContentType=content_type
+        )['UploadId']
+        self.buffer = bytearray()
+        self.position = 0
+        self.part_futures = []
+        self.pending = []
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position += len(data)
+        while len(self.buffer) >= ARCHIVE_PART_SIZE:
+            part = bytes(self.buffer[:ARCHIVE_PART_SIZE])
+            del self.buffer[:ARCHIVE_PART_SIZE]
+            self.upload_part(part)
+        return len(data)
+
+    def upload_part(self, part):
+        # 控制進行中的分段上傳數量，避免讀取速度快於上傳時緩衝無限增長
+        while len(self.pending) >= ARCHIVE_UPLOADS_IN_FLIGHT:
+            self.pending.pop(0).result()
+        part_number = len(self.part_futures) + 1
+        future = archive_executor.submit(
+            s3_client.upload_part,
+            Bucket=output_bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=part
+        )
+        self.part_futures.append(future)
+        self.pending.append(future)
+
+    def complete(self):
+        if self.buffer or not self.part_futures:
+            self.upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        parts = [
+            {'ETag': future.result()['ETag'], 'PartNumber': number}
+            for number, future in enumerate(self.part_futures, start=1)
+        ]
+        s3_client.complete_multipart_upload(
+            Bucket=output_bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+
+    def abort(self):
+        for future in self.part_futures:
+            future.cancel()
+        try:
+            s3_client.abort_multipart_upload(Bucket=output_bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Error aborting multipart upload: {str(e)}")
+
+def get_lambda_client():
+    global lambda_client
+    if lambda_client is None:
+        lambda_client = boto3.client('lambda')
+    return lambda_client
+
+def handle_archive(request_body, context):
+    """處理打包下載請求：選取用戶文件（未指定則全部），返回壓縮檔的預簽名連結"""
+    try:
+        username = request_body.get('username')
+        selection = request_body.get('files') or []
+        if not username:
+            return response(400, 'Missing username')
+        
+        entries, missing = select_archive_entries(username, selection)
+        if missing:
+            return response(404, f'找不到檔案: {", ".join(missing)}')
+        if not entries:
+            return response(404, 'No files to archive')
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        archive_name = f"{username}_{timestamp}.zip"
+        archive_key = f"{ARCHIVES_PREFIX}{username}/{archive_name}"
+        # 非同步呼叫的 payload 有大小上限，只帶選取條件，執行時重新讀取索引
+        job = {'username': username, 'archiveKey': archive_key, 'files': selection}
+        total_bytes = sum(entry.size_bytes for entry in entries)
+        
+        # 大型壓縮檔交由非同步呼叫處理，避免超過 API Gateway 的逾時限制；
+        # 預簽名連結在壓縮檔完成後即可下載
+        is_async = total_bytes > ARCHIVE_SYNC_BYTES and context is not None
+        if is_async:
+            get_lambda_client().invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps({'archiveJob': job}, ensure_ascii=False).encode('utf-8')
+            )
+        else:
+            run_archive_job(job, entries)
+        
+        return response(202 if is_async else 200, '壓縮檔處理中' if is_async else '壓縮檔已建立', {
+            'archiveKey': archive_key,
+            'url': presign_archive(archive_key, archive_name),
+            'fileCount': len(entries),
+            'totalBytes': total_bytes,
+            'ready': not is_async
+        })
+        
+    except Exception as e:
+        print(f"Error creating archive: {str(e)}")
+        return response(500, f'Archive failed: {str(e)}')
+
+def handle_archive_status(request_body):
+    """查詢非同步打包的壓縮檔是否已完成（以 HEAD 檢查物件是否存在）"""
+    username = request_body.get('username')
+    archive_key = request_body.get('archiveKey') or ''
+    if not username or not archive_key.startswith(f"{ARCHIVES_PREFIX}{username}/"):
+        return response(400, 'Missing username or invalid archiveKey')
+    
+    try:
+        head = s3_client.head_object(Bucket=output_bucket, Key=archive_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return response(200, '壓縮檔處理中', {'archiveKey': archive_key, 'ready': False})
+        print(f"Error checking archive {archive_key}: {str(e)}")
+        return response(500, f'Archive status failed: {str(e)}')
+    
+    return response(200, '壓縮檔已建立', {
+        'archiveKey': archive_key,
+        'ready': True,
+        'size': head.get('ContentLength', 0)
+    })
+
+def select_archive_entries(username, selection):
+    """依檔名選取用戶文件（未指定則全部），返回 (文件記錄, 找不到的檔名)"""
+    user_files = load_files_index(username).get(username, [])
+    if not selection:
+        return user_files, []
+    entries = [entry for entry in user_files if any(entry.matches(name) for name in selection)]
+    found = {name for name in selection if any(entry.matches(name) for entry in entries)}
+    return entries, [name for name in selection if name not in found]
+
+def run_archive_job(job, entries=None):
+    """依序將來源物件串流寫入 ZIP；以有限的預取池提前開啟後續物件的讀取
+
+    非同步呼叫時 entries 為 None，依 job 的選取條件重新讀取索引（期間被刪除的文件略過）。
+    """
+    if entries is None:
+        entries, missing = select_archive_entries(job['username'], job.get('files'))
+        if missing:
+            print(f"Files removed before archiving, skipped: {missing}")
+    writer = MultipartUploadWriter(job['archiveKey'])
+    try:
+        s3_keys = [entry.s3_key for entry in entries]
+        names = unique_archive_names([entry.name for entry in entries])
+        prefetched = {}
+        
+        def prefetch(index):
+            if index < len(s3_keys) and index not in prefetched:
+                prefetched[index] = archive_executor.submit(
+                    s3_client.get_object, Bucket=output_bucket, Key=s3_keys[index]
+                )
+        
+        for index in range(min(ARCHIVE_PREFETCH, len(s3_keys))):
+            prefetch(index)
+        
+        # 已壓縮的圖片再壓縮效益不大，使用 ZIP_STORED；超過 4 GB 時使用 ZIP64
+        with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for index, name in enumerate(names):
+                source = prefetched.pop(index).result()
+                prefetch(index + ARCHIVE_PREFETCH)
+                modified = source.get('LastModified') or datetime.now()
+                info = zipfile.ZipInfo(name, date_time=modified.timetuple()[:6])
+                with archive.open(info, 'w', force_zip64=True) as dest:
+                    for chunk in source['Body'].iter_chunks(ARCHIVE_READ_CHUNK):
+                        dest.write(chunk)
+        
+        writer.complete()
+        record_access(s3_keys)
+        print(f"Archive created for user {job['username']}: {job['archiveKey']} ({writer.position} bytes)")
+        return {'statusCode': 200, 'body': json.dumps({'archiveKey': job['archiveKey'], 'size': writer.position})}
+        
+    except Exception as e:
+        writer.abort()
+        print(f"Error writing archive {job['archiveKey']}: {str(e)}")
+        raise e
+
+def unique_archive_names(names):
+    """壓縮檔內的檔名不可重複，重複的名稱加上 (n) 後綴"""
+    seen = {}
+    result = []
+    for name in names:
+        candidate = name
+        base, ext = os.path.splitext(name)
+        while candidate in seen:
+            seen[name] += 1
+            candidate = f"{base} ({seen[name]}){ext}"
+        seen.setdefault(name, 0)
+        seen[candidate] = 0
+        result.append(candidate)
+    return result
+
+def presign_archive(archive_key, archive_name):
+    """產生附帶下載檔名的預簽名 GET 連結"""
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': output_bucket,
+            'Key': archive_key,
+            'ResponseContentDisposition': f'attachment; filename="{archive_name}"'
+        },
+        ExpiresIn=ARCHIVE_URL_EXPIRES
+    )
+
+# 新增：文件存取計數（供 storage_tiering 判斷冷資料）
+# 計數寫成新的 S3 物件，不需讀取-修改-寫入；流量高時在 warm container 記憶體中累積，
+# 距上次寫出不到 ACCESS_FLUSH_SECONDS 的計數才暫存，並由之後任何請求在逾時後寫出
+ACCESS_BATCH_PREFIX = 'stats/access/batches/'
+ACCESS_FLUSH_SECONDS = int(os.environ.get('ACCESS_FLUSH_SECONDS', '60'))
+ACCESS_FLUSH_MAX_KEYS = 500
+ACCESS_MAX_KEYS_PER_REQUEST = 100
+access_counters = {}
+access_state = {'last_flush': 0.0, 'oldest': None}
+access_lock = threading.Lock()
+
+def handle_access(request_body):
+    """記錄文件在列表之外被檢視（前端以 keepalive 請求回報，不影響圖片本身的載入延遲）
+
+    列表與打包下載由後端直接計入（見 handle_get_files、run_archive_job）。
+    """
+    s3_keys = request_body.get('s3Keys') or []
+    if not request_body.get('username') or not isinstance(s3_keys, list):
+        return response(400, 'Missing username or s3Keys')
+    
+    record_access(s3_keys[:ACCESS_MAX_KEYS_PER_REQUEST])
+    return {
+        'statusCode': 204,
+        'headers': CORS_HEADERS,
+        'body': ''
+    }
+
+def record_access(s3_keys):
+    """累加存取次數與最後存取時間；流量低（上次寫出已超過 ACCESS_FLUSH_SECONDS）時立即寫出，
+    否則暫存到數量門檻或由 flush_stale_access 寫出。寫出於 io_executor 背景執行，不增加請求延遲"""
+    now = now_ms()
+    with access_lock:
+        for s3_key in s3_keys:
+            counter = access_counters.setdefault(s3_key, [0, 0])
+            counter[0] += 1
+            counter[1] = now
+        if access_state['oldest'] is None:
+            access_state['oldest'] = time.time()
+        
+        if (len(access_counters) >= ACCESS_FLUSH_MAX_KEYS
+                or time.time() - access_state['last_flush'] >= ACCESS_FLUSH_SECONDS):
+            batch = take_access_batch()
+        else:
+            batch = None
+    
+    if batch:
+        io_executor.submit(flush_access_batch, batch)
+
+def flush_stale_access():
+    """每個請求呼叫：暫存的計數超過 ACCESS_FLUSH_SECONDS 時於背景寫出，不必等下一個存取回報"""
+    with access_lock:
+        oldest = access_state['oldest']
+        if oldest is None or time.time() - oldest < ACCESS_FLUSH_SECONDS:
+            return
+        batch = take_access_batch()
+    io_executor.submit(flush_access_batch, batch)
+
+def take_access_batch():
+    """取出暫存的計數（呼叫端需持有 access_lock）"""
+    batch = dict(access_counters)
+    access_counters.clear()
+    access_state['last_flush'] = time.time()
+    access_state['oldest'] = None
+    return batch
+
+def flush_access_batch(batch):
+    """將一批計數寫成獨立物件，由 storage_tiering 合併；寫入失敗時捨棄（計數為盡力而為）"""
+    batch_key = f"{ACCESS_BATCH_PREFIX}{now_ms()}-{uuid.uuid4().hex}.json"
+    try:
+        s3_client.put_object(
+            Bucket=output_bucket,
+            Key=batch_key,
+            Body=json.dumps(batch, ensure_ascii=False, separators=(',', ':')),
+            ContentType='application/json'
+        )
+        print(f"Flushed access counters for {len(batch)} files: {batch_key}")
+    except Exception as e:
+        print(f"Error flushing access counters: {str(e)}")
+
+# 新增：Idempotency-Key 支援（POST / PUT / DELETE）
+# 紀錄存於 S3（以條件寫入避免同一鍵被並行執行兩次），warm container 內另以 LRU 快取已完成的結果
+IDEMPOTENT_METHODS = ('POST', 'PUT', 'DELETE')
+IDEMPOTENCY_PREFIX = 'idempotency/'
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 60 * 60)))
+IDEMPOTENCY_IN_PROGRESS_SECONDS = 120     # 執行中紀錄逾時後（例如 Lambda 中途終止）允許重新執行
+IDEMPOTENCY_CACHE_SIZE = 1024
+IDEMPOTENCY_RETRY_AFTER_SECONDS = 2      # 同一鍵仍在處理中時建議客戶端等待的秒數
+idempotency_cache = OrderedDict()
+idempotency_lock = threading.Lock()
+
+def handle_idempotent(idempotency_key, event, http_method, execute):
+    """以 Idempotency-Key 包裝寫入請求：首次執行並保存結果，重送時返回保存的結果"""
+    key_hash = hashlib.sha256(idempotency_key.encode('utf-8')).hexdigest()
+    fingerprint = request_fingerprint(event, http_method)
+    
+    # 1. warm container 快取
+    cached = get_cached_idempotent(key_hash)
+    if cached is not None:
+        return replay_idempotent(cached, fingerprint)
+    
+    # 2. 以條件寫入建立「執行中」紀錄；已有紀錄時依其狀態返回
+    existing = claim_idempotency_key(key_hash, fingerprint)
+    if existing is not None:
+        if existing['status'] == 'completed':
+            cache_idempotent(key_hash, existing)
+            return replay_idempotent(existing, fingerprint)
+        if existing['fingerprint'] != fingerprint:
+            return response(422, 'Idempotency-Key 已用於不同的請求')
+        busy = response(409, '相同 Idempotency-Key 的請求仍在處理中，請稍後重試')
+        busy['headers'].update({
+            'Retry-After': str(IDEMPOTENCY_RETRY_AFTER_SECONDS),
+            'Access-Control-Expose-Headers': 'Retry-After'
+        })
+        return busy
+    
+    # 3. 執行請求；5xx 或例外時刪除紀錄讓客戶端可以重試
+    try:
+        result = execute()
+    except Exception:
+        release_idempotency_key(key_hash)
+        raise
+    
+    if result.get('statusCode', 500) >= 500:
+        release_idempotency_key(key_hash)
+        return result
+    
+    record = {
+        'status': 'completed',
+        'fingerprint': fingerprint,
+        'response': result,
+        'expiresAt': time.time() + IDEMPOTENCY_TTL_SECONDS
+    }
+    try:
+        put_idempotency_record(key_hash, record)
+        cache_idempotent(key_hash, record)
+    except Exception as e:
+        print(f"Error saving idempotency record: {str(e)}")
+    return result
+
+def request_fingerprint(event, http_method):
+    """以方法、查詢參數與解析後的主體計算請求指紋，偵測同一個鍵被用於不同請求"""
+    digest = hashlib.sha256(http_method.upper().encode('utf-8'))
+    digest.update(json.dumps(event.get('queryStringParameters') or {}, sort_keys=True).encode('utf-8'))
+    digest.update(json.dumps(fingerprint_body(event), sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def fingerprint_body(event):
+    """請求主體中決定請求內容的部分
+
+    瀏覽器每次送出 FormData 都會產生新的 boundary，multipart 主體以欄位（用戶、檔名與內容雜湊）表示，
+    重試同一個上傳不會被視為不同的請求；JSON 主體以解析後的內容表示，不受欄位順序與空白影響。
+    """
+    content_type = get_header(event, 'Content-Type') or ''
+    if 'multipart/form-data' in content_type and event.get('isBase64Encoded') and event.get('body'):
+        fields = parse_multipart_form(base64.b64decode(event['body']), content_type)
+        if fields is not None:
+            username, filename, file_content = fields
+            return {
+                'username': username,
+                'filename': filename,
+                'contentSha256': hashlib.sha256(file_content).hexdigest() if file_content is not None else None
+            }
+    request_body = parse_json_body(event)
+    if request_body is not None:
+        return request_body
+    return event.get('body') or ''
+
+def replay_idempotent(record, fingerprint):
+    if record['fingerprint'] != fingerprint:
+        return response(422, 'Idempotency-Key 已用於不同的請求')
+    replayed = dict(record['response'])
+    replayed['headers'] = {**(replayed.get('headers') or {}), 'Idempotent-Replayed': 'true'}
+    return replayed
+
+def get_cached_idempotent(key_hash):
+    with idempotency_lock:
+        record = idempotency_cache.get(key_hash)
+        if record is None:
+            return None
+        if record['expiresAt'] < time.time():
+            del idempotency_cache[key_hash]
+            return None
+        idempotency_cache.move_to_end(key_hash)
+        return record
+
+def cache_idempotent(key_hash, record):
+    with idempotency_lock:
+        idempotency_cache[key_hash] = record
+        idempotency_cache.move_to_end(key_hash)
+        while len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+            idempotency_cache.popitem(last=False)
+
+def claim_idempotency_key(key_hash, fingerprint):
+    """建立執行中紀錄；成功返回 None，已有有效紀錄時返回該紀錄（過期紀錄會被接手）"""
+    record = {
+        'status': 'in_progress',
+        'fingerprint': fingerprint,
+        'expiresAt': time.time() + IDEMPOTENCY_IN_PROGRESS_SECONDS
+    }
+    try:
+        put_idempotency_record(key_hash, record, IfNoneMatch='*')
+        return None
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            raise e
+    
+    try:
+        stored = s3_client.get_object(Bucket=output_bucket, Key=f"{IDEMPOTENCY_PREFIX}{key_hash}.json")
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            # 紀錄剛被刪除（前一次執行失敗），視為仍在處理中讓客戶端重試
+            return {'status': 'in_progress', 'fingerprint': fingerprint}
+        raise e
+    existing = json.loads(stored['Body'].read())
+    if existing['expiresAt'] >= time.time():
+        return existing
+    
+    # 紀錄已過期：以 ETag 條件覆寫接手，失敗代表另一個請求已搶先接手
+    try:
+        put_idempotency_record(key_hash, record, IfMatch=stored['ETag'])
+        return None
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            return {'status': 'in_progress', 'fingerprint': fingerprint}
+        raise e
+
+def put_idempotency_record(key_hash, record, **condition):
+    s3_client.put_object(
+        Bucket=output_bucket,
+        Key=f"{IDEMPOTENCY_PREFIX}{key_hash}.json",
+        Body=json.dumps(record, ensure_ascii=False),
+        ContentType='application/json',
+        **condition
+    )
+
+def release_idempotency_key(key_hash):
+    try:
+        s3_client.delete_object(Bucket=output_bucket, Key=f"{IDEMPOTENCY_PREFIX}{key_hash}.json")
+    except Exception as e:
+        print(f"Error releasing idempotency key: {str(e)}")
+
+# 新增：以參照分享文件
+# 接收者索引中加入指向擁有者 s3Key 的記錄（owner 欄位為擁有者），不複製物件，
+# 分享所需時間與儲存空間與文件大小無關；擁有者記錄的 shared_with 用於撤銷與連帶刪除
+USERS_PROFILES_PREFIX = 'users/profiles/'
+
+def handle_share(request_body):
+    """將自己擁有的文件分享給另一位用戶"""
+    username = (request_body.get('username') or '').strip()
+    filename = (request_body.get('filename') or '').strip()
+    recipient = (request_body.get('recipient') or '').strip()
+    if not username or not filename or not recipient:
+        return response(400, '缺少使用者名稱、檔案名稱或分享對象')
+    if recipient == username:
+        return response(400, '無法分享給自己')
+    
+    try:
+        recipient_future = io_executor.submit(user_exists, recipient)
+        indexes = load_user_indexes([username, recipient])
+        if not recipient_future.result():
+            return response(404, f'找不到使用者: {recipient}')
+        
+        files_index = indexes[username]
+        target_file = next((f for f in files_index.get(username, []) if f.matches(filename)), None)
+        if target_file is None:
+            return response(404, f'找不到檔案: {filename}')
+        if target_file.owner:
+            return response(403, '只能分享自己擁有的檔案')
+        
+        recipient_index = indexes[recipient]
+        if recipient in (target_file.shared_with or []) or find_reference(
+                recipient_index, recipient, username, target_file.s3_key) is not None:
+            return response(409, f'已分享給 {recipient}')
+        
+        # 先更新擁有者的分享清單再加入參照；衝突重試時依鍵值重新尋找，期間被刪除則不加入參照
+        s3_key = target_file.s3_key
+        shared = {}
+        
+        def add_recipient(files_index):
+            entry = next((f for f in files_index.get(username, []) if f.s3_key == s3_key and not f.owner), None)
+            shared['entry'] = entry
+            if entry is None or recipient in (entry.shared_with or []):
+                return False
+            entry.shared_with = (entry.shared_with or []) + [recipient]
+            touch_entry(files_index, username, entry)
+            return True
+        
+        def add_reference(files_index):
+            entry = shared['entry']
+            if entry is None or find_reference(files_index, recipient, username, s3_key) is not None:
+                return False
+            files_index[recipient] = files_index.get(recipient, []) + [FileEntry(
+                name=entry.name,
+                s3_key=s3_key,
+                size_bytes=entry.size_bytes,
+                uploaded_at=now_ms(),
+                content_type=entry.content_type,
+                storage_class=entry.storage_class,
+                owner=username
+            )]
+            files_index.record_change(recipient, 'add', s3_key)
+            return True
+        
+        update_user_indexes([(username, add_recipient), (recipient, add_reference)], loaded=indexes)
+        if shared['entry'] is None:
+            return response(404, f'找不到檔案: {filename}')
+        
+        print(f"User {username} shared {s3_key} with {recipient}")
+        return response(200, '檔案分享成功', {'filename': shared['entry'].name, 'recipient': recipient})
+    
+    except Exception as e:
+        print(f"Error sharing file: {str(e)}")
+        return response(500, f'分享檔案失敗: {str(e)}')
+
+def handle_unshare(request_body):
+    """擁有者撤銷對某位用戶的分享（接收者自行移除參照請使用 DELETE）"""
+    username = (request_body.get('username') or '').strip()
+    filename = (request_body.get('filename') or '').strip()
+    recipient = (request_body.get('recipient') or '').strip()
+    if not username or not filename or not recipient:
+        return response(400, '缺少使用者名稱、檔案名稱或分享對象')
+    
+    try:
+        indexes = load_user_indexes([username, recipient])
+        files_index = indexes[username]
+        target_file = next((f for f in files_index.get(username, []) if f.matches(filename)), None)
+        if target_file is None:
+            return response(404, f'找不到檔案: {filename}')
+        if target_file.owner:
+            return response(403, '只能撤銷自己擁有的檔案的分享')
+        if recipient not in (target_file.shared_with or []):
+            return response(404, f'檔案未分享給 {recipient}')
+        
+        s3_key = target_file.s3_key
+        update_user_indexes([
+            (username, lambda files_index: remove_recipient(files_index, username, s3_key, recipient)),
+            (recipient, lambda files_index: drop_reference(files_index, recipient, username, s3_key))
+        ], loaded=indexes)
+        
+        print(f"User {username} revoked {target_file.s3_key} from {recipient}")
+        return response(200, '已撤銷分享', {'filename': target_file.name, 'recipient': recipient})
+    
+    except Exception as e:
+        print(f"Error revoking share: {str(e)}")
+        return response(500, f'撤銷分享失敗: {str(e)}')
+
+def user_exists(username):
+    """以個人資料物件是否存在判斷用戶是否已註冊"""
+    try:
+        s3_client.head_object(Bucket=output_bucket, Key=f'{USERS_PROFILES_PREFIX}{username}.json')
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise e
+
+def find_reference(files_index, recipient, owner, s3_key):
+    """在接收者的文件中尋找指向擁有者物件的參照"""
+    for entry in files_index.get(recipient, []):
+        if entry.owner == owner and entry.s3_key == s3_key:
+            return entry
+    return None
+
+def find_shared_entry(files_index, owner, s3_key):
+    """在擁有者的文件中尋找被分享的原始記錄"""
+    for entry in files_index.get(owner, []):
+        if not entry.owner and entry.s3_key == s3_key and entry.shared_with:
+            return entry
+    return None
+
+def drop_reference(files_index, recipient, owner, s3_key):
+    """移除接收者索引中的參照並記錄變更"""
+    reference = find_reference(files_index, recipient, owner, s3_key)
+    if reference is None:
+        return False
+    files_index[recipient].remove(reference)
+    files_index.record_change(recipient, 'remove', s3_key)
+    return True
+
+def remove_recipient(files_index, owner, s3_key, recipient):
+    """從擁有者記錄的分享清單移除接收者並記錄變更"""
+    entry = find_shared_entry(files_index, owner, s3_key)
+    if entry is None or recipient not in entry.shared_with:
+        return False
+    entry.shared_with = [name for name in entry.shared_with if name != recipient]
+    touch_entry(files_index, owner, entry)
+    return True
+
+def touch_entry(files_index, username, entry):
+    """記錄內容變更但鍵值不變（如分享清單），以同一鍵值的 rename 通知客戶端更新該記錄"""
+    files_index.record_change(username, 'rename', entry.s3_key, entry.s3_key)
@@ -0,0 +1,389 @@
+import json
+import os
+from datetime import datetime, timezone
+from urllib.parse import unquote
+from botocore.exceptions import ClientError
+
+# 精簡索引格式版本（舊版 JSON 索引沒有此欄位）
+INDEX_FORMAT_VERSION = 2
+
+# 每位用戶保留的變更紀錄筆數上限（超過時捨棄最舊的紀錄，客戶端改取完整列表）
+# 紀錄存於共用索引內，每次讀寫索引都要傳輸與解析，因此另以用戶文件數為上限：
+# 變更多於文件數時完整列表不比增量大，保留更多紀錄只會讓索引變大
+CHANGE_LOG_LIMIT = 200
+CHANGE_LOG_MIN = 8
+
+# 條件寫入衝突（其他寫入者搶先更新索引）時重新讀取並重新套用變更的次數
+INDEX_UPDATE_RETRIES = 8
+WRITE_CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+
+# 上傳時寫入的原始檔名 metadata（值經 URL 編碼以支援非 ASCII 字元）
+ORIGINAL_NAME_METADATA = 'original-name'
+
+# 索引中以整數代號記錄的 S3 儲存類別（0 為預設的 STANDARD；只可在尾端新增）
+STORAGE_CLASSES = [
+    'STANDARD', 'STANDARD_IA', 'ONEZONE_IA', 'INTELLIGENT_TIERING', 'GLACIER_IR',
+    'GLACIER', 'DEEP_ARCHIVE', 'REDUCED_REDUNDANCY', 'OUTPOSTS', 'SNOW', 'EXPRESS_ONEZONE'
+]
+
+# 公開 URL 由 s3Key 推導，不再存入索引
+# 使用本地 S3 相容服務時以環境變數覆寫公開網址格式
+PUBLIC_URL_TEMPLATE = os.environ.get('PUBLIC_URL_TEMPLATE', 'https://{bucket}.s3.amazonaws.com/{key}')
+
+class FileIndex(dict):
+    """{username: [FileEntry, ...]}，並記錄索引版本（每次寫入時遞增）
+
+    另為每位用戶維護單調遞增的版本與有限長度的變更紀錄，
+    紀錄格式為 [version, op, s3Key, newS3Key]，op 為 'add'、'remove' 或 'rename'；
+    newS3Key 與 s3Key 相同（或為 add / remove）時省略。
+    etag 為讀取時 S3 物件的 ETag（不存在時為 None），寫回時作為條件。
+    """
+    __slots__ = ('version', 'user_versions', 'change_logs', 'log_floors', 'etag')
+
+    def __init__(self, *args, version=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = version
+        self.etag = None
+        self.user_versions = {}
+        self.change_logs = {}
+        self.log_floors = {}    # 已被捨棄的最新紀錄版本，早於此版本的增量無法還原
+
+    def user_version(self, username):
+        return self.user_versions.get(username, 0)
+
+    def record_change(self, username, op, s3_key, new_key=None):
+        """記錄一次用戶文件變更並遞增該用戶版本"""
+        version = self.user_version(username) + 1
+        self.user_versions[username] = version
+        record = [version, op, s3_key]
+        if new_key is not None and new_key != s3_key:
+            record.append(new_key)
+        self.change_logs.setdefault(username, []).append(record)
+        self.trim_change_log(username)
+        return version
+
+    def change_log_limit(self, username):
+        return min(CHANGE_LOG_LIMIT, max(CHANGE_LOG_MIN, len(self.get(username, ()))))
+
+    def trim_change_log(self, username):
+        """捨棄超過上限的最舊紀錄並記錄截斷位置"""
+        log = self.change_logs.get(username)
+        limit = self.change_log_limit(username)
+        if log and len(log) > limit:
+            dropped = len(log) - limit
+            self.log_floors[username] = log[dropped - 1][0]
+            del log[:dropped]
+
+    def changes_since(self, username, since):
+        """合併 since 之後的變更，返回 (added, removed, renamed)；紀錄已被截斷時返回 None
+
+        added 為新增的 s3Key 清單，removed 為移除的 s3Key 清單，
+        renamed 為 {原 s3Key: 新 s3Key}；同一文件的多次變更會合併為淨效果。
+        """
+        if since < self.log_floors.get(username, 0) or since > self.user_version(username):
+            return None
+
+        added = {}
+        removed = {}
+        renamed = {}
+        origin_of = {}          # 重新命名後的 s3Key -> 客戶端已知的原 s3Key
+        for version, op, s3_key, *rest in self.change_logs.get(username, []):
+            if version <= since:
+                continue
+            new_key = rest[0] if rest and rest[0] is not None else s3_key
+            if op == 'add':
+                added[s3_key] = True
+            elif op == 'remove':
+                if s3_key in added:
+                    del added[s3_key]
+                elif s3_key in origin_of:
+                    origin = origin_of.pop(s3_key)
+                    del renamed[origin]
+                    removed[origin] = True
+                else:
+                    removed[s3_key] = True
+            elif op == 'rename':
+                if s3_key in added:
+                    del added[s3_key]
+                    added[new_key] = True
+                else:
+                    origin = origin_of.pop(s3_key, s3_key)
+                    renamed[origin] = new_key
+                    origin_of[new_key] = origin
+        return list(added), list(removed), renamed
+
+class FileEntry:
+    """索引中的單一文件記錄（型別化欄位，使用 __slots__ 降低記憶體用量）
+
+    owner 不為 None 時為他人分享的參照，s3_key 指向擁有者的物件；
+    shared_with 為擁有者記錄上的接收者清單，用於撤銷分享與連帶刪除參照。
+    """
+    __slots__ = ('name', 's3_key', 'size_bytes', 'uploaded_at', 'modified_at', 'content_type', 'storage_class',
+                 'owner', 'shared_with')
+
+    def __init__(self, name, s3_key, size_bytes, uploaded_at, content_type, modified_at=0,
+                 storage_class='STANDARD', owner=None, shared_with=None):
+        self.name = name
+        self.s3_key = s3_key
+        self.size_bytes = size_bytes      # int，位元組數
+        self.uploaded_at = uploaded_at    # int，epoch 毫秒
+        self.modified_at = modified_at    # int，epoch 毫秒，0 表示未修改過
+        self.content_type = content_type
+        self.storage_class = storage_class
+        self.owner = owner
+        self.shared_with = shared_with    # list 或 None（未分享）
+
+    @property
+    def unique_name(self):
+        return self.s3_key.rsplit('/', 1)[-1]
+
+    def matches(self, filename):
+        """以顯示名稱或唯一名稱比對文件"""
+        return self.name == filename or self.unique_name == filename
+
+    @classmethod
+    def from_legacy(cls, file_info):
+        """由舊版 JSON 記錄（字串型別欄位）轉換"""
+        uploaded_at = parse_iso_ms(file_info.get('uploadTime')) or parse_iso_ms(file_info.get('uploadDate'))
+        return cls(
+            name=file_info.get('name', ''),
+            s3_key=file_info.get('s3Key', ''),
+            size_bytes=parse_file_size(file_info.get('size')),
+            uploaded_at=uploaded_at,
+            content_type=file_info.get('type', 'application/octet-stream'),
+            modified_at=parse_iso_ms(file_info.get('lastModifiedTime'))
+        )
+
+    @classmethod
+    def from_head(cls, s3_key, head, uploaded_at=None):
+        """由 HEAD 取得的物件 metadata 建立記錄（用於事件處理與索引重建）"""
+        original_name = head.get('Metadata', {}).get(ORIGINAL_NAME_METADATA)
+        if uploaded_at is None:
+            uploaded_at = int(head['LastModified'].timestamp() * 1000) if head.get('LastModified') else now_ms()
+        return cls(
+            name=unquote(original_name) if original_name else s3_key.rsplit('/', 1)[-1],
+            s3_key=s3_key,
+            size_bytes=head.get('ContentLength', 0),
+            uploaded_at=uploaded_at,
+            content_type=head.get('ContentType', 'application/octet-stream'),
+            storage_class=head.get('StorageClass', 'STANDARD')
+        )
+
+    def to_response(self, bucket):
+        """於回應時推導出前端使用的欄位（與舊版索引記錄格式相同）"""
+        uploaded = ms_to_datetime(self.uploaded_at)
+        info = {
+            'name': self.name,
+            'uniqueName': self.unique_name,
+            's3Key': self.s3_key,
+            'url': PUBLIC_URL_TEMPLATE.format(bucket=bucket, key=self.s3_key),
+            'size': format_file_size(self.size_bytes),
+            'sizeBytes': self.size_bytes,
+            'uploadDate': uploaded.strftime('%Y-%m-%d'),
+            'uploadTime': to_iso(uploaded),
+            'type': self.content_type
+        }
+        if self.modified_at:
+            modified = ms_to_datetime(self.modified_at)
+            info['lastModified'] = modified.strftime('%Y-%m-%d')
+            info['lastModifiedTime'] = to_iso(modified)
+        if self.owner:
+            info['sharedBy'] = self.owner
+        if self.shared_with:
+            info['sharedWith'] = list(self.shared_with)
+        return info
+
+def now_ms():
+    """目前時間（epoch 毫秒）"""
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+def ms_to_datetime(ms):
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+def to_iso(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + f'{dt.microsecond // 1000:03d}Z'
+
+def parse_iso_ms(value):
+    """解析舊版 ISO 時間字串為 epoch 毫秒，無法解析時返回 0"""
+    if not value:
+        return 0
+    try:
+        dt = datetime.fromisoformat(value.rstrip('Z'))
+    except ValueError:
+        return 0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+SIZE_UNITS = ["B", "KB", "MB", "GB"]
+
+def format_file_size(size_bytes):
+    """格式化文件大小"""
+    if size_bytes == 0:
+        return "0 B"
+
+    i = 0
+    while size_bytes >= 1024 and i < len(SIZE_UNITS) - 1:
+        size_bytes /= 1024.0
+        i += 1
+
+    return f"{size_bytes:.1f} {SIZE_UNITS[i]}"
+
+def parse_file_size(value):
+    """將舊版格式化大小字串（如 "512.3 KB"）還原為位元組數（近似值）"""
+    if isinstance(value, int):
+        return value
+    try:
+        number, unit = str(value).split()
+        return int(float(number) * 1024 ** SIZE_UNITS.index(unit))
+    except (ValueError, AttributeError):
+        return 0
+
+def decode_index(raw):
+    """解析索引內容，返回 FileIndex；同時接受舊版 JSON 格式（版本視為 0）"""
+    if not raw:
+        return FileIndex()
+    document = json.loads(raw)
+    if document.get('format') != INDEX_FORMAT_VERSION:
+        # 舊版格式：{username: [ {name, uniqueName, s3Key, url, size, ...}, ... ]}
+        return FileIndex({
+            username: [FileEntry.from_legacy(info) for info in files]
+            for username, files in document.items()
+        })
+
+    types = document.get('types', [])
+    files_index = FileIndex(version=document.get('version', 0))
+    for username, columns in document.get('users', {}).items():
+        count = len(columns['name'])
+        tiers = columns.get('tier') or [0] * count
+        # 分享相關欄位只在用戶有分享記錄時寫入
+        owners = columns.get('owner') or [None] * count
+        shared = columns.get('sharedWith') or [None] * count
+        files_index.user_versions[username] = columns.get('version', 0)
+        if columns.get('changes'):
+            files_index.change_logs[username] = columns['changes']
+        if columns.get('logFloor'):
+            files_index.log_floors[username] = columns['logFloor']
+        files_index[username] = [
+            FileEntry(name, s3_key, size_bytes, uploaded_at, types[type_id], modified_at, STORAGE_CLASSES[tier],
+                      owner, shared_with)
+            for name, s3_key, size_bytes, uploaded_at, modified_at, type_id, tier, owner, shared_with in zip(
+                columns['name'], columns['s3Key'], columns['size'],
+                columns['uploadedAt'], columns['modifiedAt'], columns['type'], tiers, owners, shared
+            )
+        ]
+    return files_index
+
+def encode_index(files_index):
+    """將索引編碼為精簡欄式 JSON（每位用戶一組欄位陣列，Content-Type 以字典編碼）"""
+    types = []
+    type_ids = {}
+    users = {}
+    for username, entries in files_index.items():
+        type_column = []
+        for entry in entries:
+            type_id = type_ids.get(entry.content_type)
+            if type_id is None:
+                type_id = type_ids[entry.content_type] = len(types)
+                types.append(entry.content_type)
+            type_column.append(type_id)
+        users[username] = {
+            'name': [entry.name for entry in entries],
+            's3Key': [entry.s3_key for entry in entries],
+            'size': [entry.size_bytes for entry in entries],
+            'uploadedAt': [entry.uploaded_at for entry in entries],
+            'modifiedAt': [entry.modified_at for entry in entries],
+            'type': type_column,
+            'tier': [STORAGE_CLASSES.index(entry.storage_class) for entry in entries]
+        }
+        if any(entry.owner for entry in entries):
+            users[username]['owner'] = [entry.owner for entry in entries]
+        if any(entry.shared_with for entry in entries):
+            users[username]['sharedWith'] = [entry.shared_with or None for entry in entries]
+        # 版本與變更紀錄只在用戶有變更時寫入（解碼時缺少即為 0 / 空）
+        if isinstance(files_index, FileIndex) and files_index.user_version(username):
+            users[username]['version'] = files_index.user_version(username)
+            if files_index.log_floors.get(username):
+                users[username]['logFloor'] = files_index.log_floors[username]
+            if files_index.change_logs.get(username):
+                users[username]['changes'] = files_index.change_logs[username]
+
+    document = {
+        'format': INDEX_FORMAT_VERSION,
+        'version': getattr(files_index, 'version', 0),
+        'types': types,
+        'users': users
+    }
+    return json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def load_index(s3_client, bucket, key):
+    """從 S3 讀取並解析索引，索引不存在時返回空索引"""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return FileIndex()
+        raise e
+    files_index = decode_index(response['Body'].read())
+    files_index.etag = response['ETag']
+    return files_index
+
+def load_index_if_changed(s3_client, bucket, key, etag=None):
+    """條件式讀取索引，返回 (index, etag)；S3 ETag 未變時 index 為 None，省去下載與解析"""
+    kwargs = {'IfNoneMatch': etag} if etag else {}
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key, **kwargs)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ('304', 'NotModified'):
+            return None, etag
+        if code == 'NoSuchKey':
+            return FileIndex(), None
+        raise e
+    files_index = decode_index(response['Body'].read())
+    files_index.etag = response['ETag']
+    return files_index, response['ETag']
+
+def save_index(s3_client, bucket, key, files_index):
+    """以精簡格式將索引條件寫回 S3（索引版本遞增）
+
+    只在 S3 上的索引仍是讀取時的那一份（ETag 相符，讀取時不存在則仍不存在）才寫入，
+    否則拋出 PreconditionFailed 的 ClientError；需要重試時使用 update_index。
+    """
+    etag = getattr(files_index, 'etag', None)
+    files_index.version = getattr(files_index, 'version', 0) + 1
+    if isinstance(files_index, FileIndex):
+        # 文件數減少或由較長上限的舊版索引讀入時，寫回前一併截斷
+        for username in list(files_index.change_logs):
+            files_index.trim_change_log(username)
+    response = s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=encode_index(files_index),
+        ContentType='application/json',
+        **({'IfMatch': etag} if etag else {'IfNoneMatch': '*'})
+    )
+    files_index.etag = response.get('ETag')
+
+def is_write_conflict(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in WRITE_CONFLICT_CODES
+
+def update_index(s3_client, bucket, key, mutate, files_index=None):
+    """讀取-修改-條件寫入索引，返回寫入（或未變更）後的索引
+
+    mutate(files_index) 就地修改索引並返回是否有變更，無變更時不寫入；
+    其他寫入者（Lambda、S3 事件、離線工具）搶先寫入時重新讀取並重新套用，mutate 需可重複執行。
+    files_index 為剛讀取的索引時可省去第一次讀取。
+    """
+    for attempt in range(INDEX_UPDATE_RETRIES):
+        if files_index is None:
+            files_index = load_index(s3_client, bucket, key)
+        if not mutate(files_index):
+            return files_index
+        try:
+            save_index(s3_client, bucket, key, files_index)
+            return files_index
+        except ClientError as e:
+            if not is_write_conflict(e) or attempt == INDEX_UPDATE_RETRIES - 1:
+                raise e
+            files_index = None
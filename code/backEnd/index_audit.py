@@ -0,0 +1,179 @@
+"""檢查文件索引與 S3 實際物件是否一致，並可由物件 metadata 重建用戶索引
+
+用法:
+    python index_audit.py audit [--workers 16]
+    python index_audit.py rebuild USERNAME [--apply]
+
+audit 以 JSON Lines 逐筆輸出差異：
+    orphan   - S3 中存在但索引沒有記錄的物件
+    dangling - 索引中有記錄但 S3 中已不存在的物件
+最後輸出一筆 summary。先列舉所有用戶名，再逐一載入索引分片，
+分片內各用戶前綴以執行緒池並行分頁列舉，每頁比對後即丟棄。
+記憶體為用戶名清單加上一個索引分片的 s3Key 集合（flat 配置下即整份索引，與 Lambda 相同）。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import boto3
+from botocore.exceptions import ClientError
+from file_index import FileEntry, load_index, update_index
+import key_layout
+
+s3_client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+BUCKET_NAME = os.environ.get('BUCKET_NAME', 'awslambda0521')
+
+output_lock = threading.Lock()
+
+def emit(record):
+    """輸出一筆 JSON Lines 紀錄（多執行緒共用 stdout）"""
+    line = json.dumps(record, ensure_ascii=False)
+    with output_lock:
+        print(line, flush=True)
+
+def iter_usernames():
+    """分頁列舉目前鍵值配置下有物件的用戶"""
+    for username, _ in key_layout.iter_user_prefixes(s3_client, BUCKET_NAME):
+        yield username
+
+def iter_user_objects(username):
+    """分頁列舉用戶前綴下的物件（略過目錄標記）"""
+    prefix = key_layout.user_prefix(username)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'] != prefix:
+                yield obj
+
+def audit_user(username, indexed_keys):
+    """比對單一用戶：逐頁消去索引中已確認存在的鍵，剩下的即為懸空記錄"""
+    orphans = 0
+    objects = 0
+    for obj in iter_user_objects(username):
+        objects += 1
+        if obj['Key'] in indexed_keys:
+            indexed_keys.discard(obj['Key'])
+        else:
+            orphans += 1
+            emit({'type': 'orphan', 'user': username, 's3Key': obj['Key'], 'size': obj['Size']})
+    for s3_key in indexed_keys:
+        emit({'type': 'dangling', 'user': username, 's3Key': s3_key})
+    return objects, orphans, len(indexed_keys)
+
+def run_bounded(executor, func, items, limit):
+    """以最多 limit 個進行中的任務處理 items（避免一次提交數百萬個 future）"""
+    pending = set()
+    for item in items:
+        if len(pending) >= limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from (future.result() for future in done)
+        pending.add(executor.submit(func, *item))
+    for future in pending:
+        yield future.result()
+
+def audit(workers):
+    # 先列舉有物件的用戶並依所在索引分組（只保留用戶名），再逐一載入索引分片比對，
+    # 同一時間只持有一個分片的 s3Key 集合
+    users_by_index = {}
+    for username in iter_usernames():
+        users_by_index.setdefault(key_layout.index_key(username), []).append(username)
+
+    def user_jobs():
+        for index_key in key_layout.all_index_keys():
+            files_index = load_index(s3_client, BUCKET_NAME, index_key)
+            # 分享參照指向擁有者前綴下的物件，由擁有者的記錄比對
+            indexed = {
+                username: {entry.s3_key for entry in entries if not entry.owner}
+                for username, entries in files_index.items()
+            }
+            del files_index
+            for username in users_by_index.pop(index_key, []):
+                yield username, indexed.pop(username, set())
+            # 索引中有記錄但 S3 已沒有任何物件的用戶
+            for username in list(indexed):
+                yield username, indexed.pop(username)
+
+    totals = {'users': 0, 'objects': 0, 'orphans': 0, 'dangling': 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for objects, orphans, dangling in run_bounded(executor, audit_user, user_jobs(), workers * 2):
+            totals['users'] += 1
+            totals['objects'] += objects
+            totals['orphans'] += orphans
+            totals['dangling'] += dangling
+
+    emit({'type': 'summary', **totals})
+    return totals
+
+def head_entry(obj):
+    """以 HEAD 取得物件 metadata 建立索引記錄；物件已被刪除時返回 None"""
+    try:
+        head = s3_client.head_object(Bucket=BUCKET_NAME, Key=obj['Key'])
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise e
+    return FileEntry.from_head(obj['Key'], head)
+
+def rebuild(username, workers, apply):
+    """依 S3 物件重建用戶索引：保留仍存在的記錄，補上孤兒物件，移除懸空記錄"""
+    index_key = key_layout.index_key(username)
+    files_index = load_index(s3_client, BUCKET_NAME, index_key)
+    existing = {entry.s3_key: entry for entry in files_index.get(username, []) if not entry.owner}
+
+    orphan_objects = []
+    for obj in iter_user_objects(username):
+        if existing.pop(obj['Key'], None) is None:
+            orphan_objects.append((obj,))
+
+    restored = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry in run_bounded(executor, head_entry, orphan_objects, workers * 2):
+            if entry is not None:
+                restored.append(entry)
+                emit({'type': 'restored', 'user': username, 's3Key': entry.s3_key, 'name': entry.name})
+    dangling = set(existing)
+    for s3_key in dangling:
+        emit({'type': 'dropped', 'user': username, 's3Key': s3_key})
+
+    # 以讀取-修改-條件寫入套用，檢查期間 Lambda 寫入的記錄（分享參照、新上傳）保留
+    def mutate(files_index):
+        user_files = files_index.get(username, [])
+        present = {entry.s3_key for entry in user_files}
+        rebuilt = [entry for entry in user_files if entry.owner or entry.s3_key not in dangling]
+        for s3_key in present & dangling:
+            files_index.record_change(username, 'remove', s3_key)
+        for entry in restored:
+            if entry.s3_key not in present:
+                rebuilt.append(entry)
+                files_index.record_change(username, 'add', entry.s3_key)
+        rebuilt.sort(key=lambda entry: entry.uploaded_at)
+        files_index[username] = rebuilt
+        return bool(present & dangling) or any(entry.s3_key not in present for entry in restored)
+
+    if apply:
+        files_index = update_index(s3_client, BUCKET_NAME, index_key, mutate, files_index)
+    else:
+        mutate(files_index)
+    emit({'type': 'summary', 'user': username, 'files': len(files_index.get(username, [])), 'applied': apply})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='文件索引與 S3 物件一致性檢查工具')
+    parser.add_argument('--workers', type=int, default=16, help='並行列舉 / HEAD 的執行緒數')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('audit', help='列出孤兒物件與懸空記錄')
+    rebuild_parser = subparsers.add_parser('rebuild', help='由 S3 物件重建指定用戶的索引')
+    rebuild_parser.add_argument('username')
+    rebuild_parser.add_argument('--apply', action='store_true', help='寫回索引（預設僅預覽）')
+    args = parser.parse_args(argv)
+
+    if args.command == 'audit':
+        totals = audit(args.workers)
+        return 1 if totals['orphans'] or totals['dangling'] else 0
+    rebuild(args.username, args.workers, args.apply)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
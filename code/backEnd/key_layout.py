@@ -0,0 +1,75 @@
+"""S3 鍵值配置：決定用戶文件與文件索引存放的位置
+
+flat   (預設) files/<username>/<檔名>，所有用戶共用單一索引 files/user_files_index.json
+hashed files/<hh>/<username>/<檔名>，hh 為用戶名雜湊的前兩個十六進位字元；
+       索引依用戶名雜湊分散為 INDEX_SHARDS 個分片 index/<分片>.json
+
+S3 的請求速率上限以前綴計算，hashed 配置讓不同用戶的物件與索引流量分散到不同前綴。
+以環境變數 KEY_LAYOUT 選擇配置；由 flat 轉換為 hashed 請使用 migrate_key_layout.py。
+"""
+import hashlib
+import os
+
+LAYOUT_FLAT = 'flat'
+LAYOUT_HASHED = 'hashed'
+KEY_LAYOUT = os.environ.get('KEY_LAYOUT', LAYOUT_FLAT)
+INDEX_SHARDS = int(os.environ.get('INDEX_SHARDS', '16'))
+
+FILES_PREFIX = 'files/'
+LEGACY_INDEX_KEY = 'files/user_files_index.json'
+INDEX_SHARD_PREFIX = 'index/'
+
+def user_hash(username):
+    return hashlib.md5(username.encode('utf-8')).hexdigest()
+
+def user_prefix(username, layout=None):
+    """用戶文件所在的前綴（含結尾斜線，也是目錄標記的鍵值）"""
+    if (layout or KEY_LAYOUT) == LAYOUT_HASHED:
+        return f'{FILES_PREFIX}{user_hash(username)[:2]}/{username}/'
+    return f'{FILES_PREFIX}{username}/'
+
+def object_key(username, unique_name, layout=None):
+    return f'{user_prefix(username, layout)}{unique_name}'
+
+def index_key(username, layout=None):
+    """存放該用戶文件記錄的索引鍵值"""
+    if (layout or KEY_LAYOUT) == LAYOUT_HASHED:
+        shard = int(user_hash(username)[:8], 16) % INDEX_SHARDS
+        return f'{INDEX_SHARD_PREFIX}{shard:03d}.json'
+    return LEGACY_INDEX_KEY
+
+def all_index_keys(layout=None):
+    """目前配置下的所有索引鍵值（供需要掃描全部用戶的工具使用）"""
+    if (layout or KEY_LAYOUT) == LAYOUT_HASHED:
+        return [f'{INDEX_SHARD_PREFIX}{shard:03d}.json' for shard in range(INDEX_SHARDS)]
+    return [LEGACY_INDEX_KEY]
+
+def parse_object_key(s3_key):
+    """由物件鍵值解析 (username, 檔名)，兩種配置皆可辨識；非用戶文件返回 None"""
+    if not s3_key.startswith(FILES_PREFIX) or s3_key == LEGACY_INDEX_KEY:
+        return None
+    parts = s3_key[len(FILES_PREFIX):].split('/')
+    if len(parts) == 2 and parts[0] and parts[1]:
+        return parts[0], parts[1]
+    if len(parts) == 3 and parts[1] and parts[2] and parts[0] == user_hash(parts[1])[:2]:
+        return parts[1], parts[2]
+    return None
+
+def iter_user_prefixes(s3_client, bucket, layout=None):
+    """列舉有物件的用戶，產生 (username, 前綴)"""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    if (layout or KEY_LAYOUT) == LAYOUT_HASHED:
+        for page in paginator.paginate(Bucket=bucket, Prefix=FILES_PREFIX, Delimiter='/'):
+            for hash_prefix in page.get('CommonPrefixes', []):
+                for user_page in paginator.paginate(Bucket=bucket, Prefix=hash_prefix['Prefix'], Delimiter='/'):
+                    for prefix in user_page.get('CommonPrefixes', []):
+                        username = prefix['Prefix'][len(hash_prefix['Prefix']):-1]
+                        if user_prefix(username, LAYOUT_HASHED) == prefix['Prefix']:
+                            yield username, prefix['Prefix']
+        return
+    for page in paginator.paginate(Bucket=bucket, Prefix=FILES_PREFIX, Delimiter='/'):
+        for prefix in page.get('CommonPrefixes', []):
+            username = prefix['Prefix'][len(FILES_PREFIX):-1]
+            # 註冊要求用戶名至少 3 個字元，兩個字元的前綴是轉換中的 hashed 配置
+            if len(username) > 2:
+                yield username, prefix['Prefix']
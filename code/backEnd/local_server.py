@@ -0,0 +1,300 @@
+"""以長時間執行的 HTTP 服務託管各 Lambda handler（機房、staging 與本地部署使用）
+
+用法:
+    python local_server.py serve [--host 0.0.0.0] [--port 8080] [--workers 16] [--mode thread|process] [--quiet]
+    python local_server.py loadtest URL [--concurrency 32] [--duration 30] [--method GET]
+                                        [--body JSON] [--header 'Name: value' ...]
+
+serve 將 HTTP 請求轉為 API Gateway（REST API，payload 1.0）事件交給對應的 lambda_handler，
+依路徑最後一段分派：/register、/login、/files（前端使用的 /main 亦可）、/analytics，
+前面可帶任意階段前綴（如 /default/files）。handler 模組只載入一次，
+模組層級的 boto3 client、執行緒池、索引與列表快取在請求之間保持 warm。
+
+    thread   所有 handler 在同一行程內由 --workers 個執行緒處理（預設，S3 I/O 為主時適用）
+    process  handler 在 --workers 個常駐子行程中執行，各子行程各自保留 warm 狀態，
+             適合壓縮、JSON 編碼等 CPU 密集的負載
+
+每條連線由各自的執行緒讀寫（閒置的 keep-alive 連線不佔用 worker，閒置 KEEPALIVE_TIMEOUT 秒後關閉），
+handler 以請求為單位交給 worker 執行，--workers 限制的是並行處理的請求數而非連線數。
+
+以 S3_ENDPOINT_URL、BUCKET_NAME（與 PUBLIC_URL_TEMPLATE）指向本地 S3 相容服務，例如 MinIO。
+沒有 Lambda context，大型壓縮檔改為同步建立。
+
+loadtest 以 --concurrency 條 keep-alive 連線持續送出同一請求 --duration 秒，
+輸出一筆 JSON：吞吐量、延遲百分位數與狀態碼分布。
+"""
+import argparse
+import base64
+import http.client
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+HANDLER_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDLER_MODULES = {
+    'register': 'register_lambda.py',
+    'login': 'login_lambda.py',
+    'files': 'file manipulate_lambda.py',
+    'analytics': 'admin_analytics_lambda.py'
+}
+ROUTE_ALIASES = {'main': 'files'}
+
+# 其餘內容類型（如 multipart/form-data、圖片）以 base64 傳遞，與 API Gateway 啟用二進位媒體類型時相同
+TEXT_CONTENT_TYPES = ('application/json', 'text/', 'application/x-www-form-urlencoded')
+KEEPALIVE_TIMEOUT = 30
+
+handlers = {}
+
+def load_handlers(quiet=False):
+    """載入各 handler 模組（檔名含空白，需以檔案路徑載入）"""
+    if quiet:
+        # handler 以 print 記錄每個事件（含上傳內容），壓測時關閉
+        sys.stdout = open(os.devnull, 'w')
+    # 本服務自行解碼 isBase64Encoded 的回應，等同 REST API 已設定二進位媒體類型
+    os.environ.setdefault('REST_BINARY_RESPONSES', 'true')
+    if HANDLER_DIR not in sys.path:
+        sys.path.insert(0, HANDLER_DIR)
+    for route, filename in HANDLER_MODULES.items():
+        module_name = os.path.splitext(filename)[0].replace(' ', '_')
+        module = sys.modules.get(module_name)
+        if module is None:
+            spec = importlib.util.spec_from_file_location(module_name, os.path.join(HANDLER_DIR, filename))
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[module_name] = module
+            spec.loader.exec_module(module)
+        handlers[route] = module.lambda_handler
+
+def invoke_handler(route, event):
+    """執行 handler（process 模式下於子行程中執行，參數與結果需可 pickle）"""
+    return handlers[route](event, None)
+
+def build_event(method, url, headers, body):
+    """將 HTTP 請求轉為 API Gateway REST API（payload 1.0）事件"""
+    query = parse_qs(url.query, keep_blank_values=True)
+    multi_headers = {}
+    for name, value in headers.items():
+        multi_headers.setdefault(name, []).append(value)
+    is_text = headers.get('Content-Type', '').startswith(TEXT_CONTENT_TYPES)
+    if not body:
+        event_body = None
+    elif is_text:
+        event_body = body.decode('utf-8', errors='replace')
+    else:
+        event_body = base64.b64encode(body).decode('ascii')
+
+    return {
+        'resource': url.path,
+        'path': url.path,
+        'httpMethod': method,
+        'headers': {name: values[-1] for name, values in multi_headers.items()},
+        'multiValueHeaders': multi_headers,
+        'queryStringParameters': {name: values[-1] for name, values in query.items()} or None,
+        'multiValueQueryStringParameters': query or None,
+        'requestContext': {
+            'httpMethod': method,
+            'path': url.path,
+            'stage': '$default',
+            'requestId': str(uuid.uuid4()),
+            'requestTimeEpoch': int(time.time() * 1000)
+        },
+        'body': event_body,
+        'isBase64Encoded': bool(body) and not is_text
+    }
+
+class LambdaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # 標頭與主體分兩次寫出，開啟 Nagle 時第二次寫入會等待客戶端延遲 ACK（約 40ms）
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.dispatch()
+
+    do_POST = do_PUT = do_DELETE = do_OPTIONS = do_HEAD = do_GET
+
+    def dispatch(self):
+        url = urlsplit(self.path)
+        segments = [segment for segment in url.path.split('/') if segment]
+        route = ROUTE_ALIASES.get(segments[-1], segments[-1]) if segments else None
+        if route not in HANDLER_MODULES:
+            self.send_result({'statusCode': 404, 'body': json.dumps({'message': 'Not Found'})})
+            return
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            self.send_result({'statusCode': 411, 'body': json.dumps({'message': 'Content-Length required'})})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        event = build_event(self.command, url, self.headers, body)
+        try:
+            result = self.server.invoke(route, event)
+        except Exception as e:
+            # 與 API Gateway 相同，handler 本身失敗（未返回回應）時返回 502
+            print(f"Handler {route} failed: {str(e)}", file=sys.stderr)
+            result = {'statusCode': 502, 'body': json.dumps({'message': 'Internal server error'})}
+        self.send_result(result)
+
+    def send_result(self, result):
+        body = result.get('body') or ''
+        if result.get('isBase64Encoded'):
+            payload = base64.b64decode(body)
+        else:
+            payload = body.encode('utf-8') if isinstance(body, str) else bytes(body)
+
+        self.send_response(result.get('statusCode', 200))
+        headers = result.get('headers') or {}
+        for name, value in headers.items():
+            if name.lower() != 'content-length':
+                self.send_header(name, str(value))
+        for name, values in (result.get('multiValueHeaders') or {}).items():
+            if name not in headers:
+                for value in values:
+                    self.send_header(name, str(value))
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+class PooledHTTPServer(ThreadingMixIn, HTTPServer):
+    """每條連線一個執行緒，handler 以請求為單位在固定大小的 worker 池（執行緒或子行程）中執行
+
+    keep-alive 連線在兩個請求之間只佔用自己的連線執行緒，請求數超過 worker 時在池中排隊，
+    不會因為其他連線保持開啟而無法取得 worker。
+    """
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, address, executor, quiet=False):
+        super().__init__(address, LambdaRequestHandler)
+        self.executor = executor
+        self.quiet = quiet
+
+    def invoke(self, route, event):
+        return self.executor.submit(invoke_handler, route, event).result()
+
+def serve(host, port, workers, mode, quiet):
+    if mode == 'process':
+        # 以 spawn 建立子行程，避免在已有執行緒的行程中 fork；子行程各自載入 handler 一次
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=load_handlers,
+            initargs=(quiet,)
+        )
+    else:
+        load_handlers(quiet)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    server = PooledHTTPServer((host, port), executor, quiet)
+    print(f"Serving {', '.join('/' + route for route in HANDLER_MODULES)} on http://{host}:{server.server_port} "
+          f"({mode} mode, {workers} workers)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        executor.shutdown(cancel_futures=True)
+    return server
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def loadtest(url, concurrency, duration, method='GET', body=None, headers=None):
+    """以多條 keep-alive 連線持續送出請求，返回吞吐量、延遲與狀態碼統計"""
+    target = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+    path = (target.path or '/') + (f'?{target.query}' if target.query else '')
+    payload = body.encode('utf-8') if body else None
+    headers = dict(headers or {})
+    if payload and 'Content-Type' not in headers:
+        headers['Content-Type'] = 'application/json'
+    deadline = time.monotonic() + duration
+
+    def run_connection():
+        latencies = []
+        statuses = Counter()
+        errors = 0
+        connection = connection_class(target.hostname, target.port, timeout=KEEPALIVE_TIMEOUT)
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=payload, headers=headers)
+                result = connection.getresponse()
+                result.read()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+                connection = connection_class(target.hostname, target.port, timeout=KEEPALIVE_TIMEOUT)
+                continue
+            latencies.append(time.perf_counter() - start)
+            statuses[result.status] += 1
+        connection.close()
+        return latencies, statuses, errors
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: run_connection(), range(concurrency)))
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    statuses = sum((result[1] for result in results), Counter())
+    report = {
+        'requests': len(latencies),
+        'errors': sum(result[2] for result in results),
+        'seconds': round(elapsed, 2),
+        'requestsPerSecond': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'latencyMs': {
+            name: round(percentile(latencies, fraction) * 1000, 2)
+            for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))
+        },
+        'status': {str(code): count for code, count in sorted(statuses.items())}
+    }
+    print(json.dumps(report), flush=True)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='以 HTTP 服務託管 Lambda handler 並進行壓力測試')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='啟動 HTTP 服務')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--workers', type=int, default=16, help='執行緒數或子行程數')
+    serve_parser.add_argument('--mode', choices=('thread', 'process'), default='thread')
+    serve_parser.add_argument('--quiet', action='store_true', help='關閉 handler 與存取紀錄輸出')
+    loadtest_parser = subparsers.add_parser('loadtest', help='對服務持續送出請求並回報吞吐量與延遲')
+    loadtest_parser.add_argument('url')
+    loadtest_parser.add_argument('--concurrency', type=int, default=32, help='同時使用的連線數')
+    loadtest_parser.add_argument('--duration', type=float, default=30, help='持續秒數')
+    loadtest_parser.add_argument('--method', default='GET')
+    loadtest_parser.add_argument('--body', help='請求主體（JSON 字串）')
+    loadtest_parser.add_argument('--header', action='append', default=[], help="額外標頭，格式 'Name: value'")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        serve(args.host, args.port, args.workers, args.mode, args.quiet)
+        return 0
+    headers = dict(header.split(':', 1) for header in args.header)
+    report = loadtest(
+        args.url, args.concurrency, args.duration, args.method, args.body,
+        {name.strip(): value.strip() for name, value in headers.items()}
+    )
+    return 1 if report['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,15 @@
 import json
+import os
 import boto3
 import hashlib
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
+from analytics import record_event
 
-s3_client = boto3.client('s3')
-BUCKET_NAME = 'awslambda0521'
+s3_client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+io_executor = ThreadPoolExecutor(max_workers=2)
+BUCKET_NAME = os.environ.get('BUCKET_NAME', 'awslambda0521')
 USERS_PROFILES_PREFIX = 'users/profiles/'
 
 def lambda_handler(event, context):
@@ -49,8 +53,10 @@ def lambda_handler(event, context):
         user_data['lastLogin'] = current_time
         user_data['loginCount'] = user_data.get('loginCount', 0) + 1
 
-        # 儲存更新的用戶資料
+        # 儲存更新的用戶資料，同時記錄管理員統計事件（單次寫入，與儲存並行）
+        analytics_future = io_executor.submit(record_event, s3_client, BUCKET_NAME, 'login', username)
         save_user_profile(username, user_data)
+        analytics_future.result()
 
         print(f"User {username} logged in successfully.")
         
@@ -0,0 +1,347 @@
+"""將用戶文件與索引由 flat 鍵值配置轉換為 hashed 配置（見 key_layout.py）
+
+用法:
+    python migrate_key_layout.py migrate [--workers 32] [--batch 500]
+    python migrate_key_layout.py cleanup [--workers 32] [--apply]
+
+轉換流程：
+1. 仍為 flat 配置時執行 migrate：依索引分片分組，以執行緒池分批並行複製物件到
+   hashed 鍵值，每批完成即寫入分片（中斷後重新執行會從未完成的文件繼續）。
+   可重複執行，分片中已被刪除或改名的記錄與其複本會一併移除。
+2. 以 KEY_LAYOUT=hashed 重新部署各 Lambda，隨即再執行一次 migrate 補上部署前的變更。
+   此時分片已在使用中，只移除由 migrate 複製（記於 index/migrated/ 的清單）
+   而舊索引中已不存在的記錄，即部署期間仍以 flat 配置執行的 Lambda 所刪除或改名的文件；
+   部署後新寫入分片的記錄不受影響。
+3. index_audit.py audit 確認無差異後執行 cleanup，刪除舊鍵值的物件、目錄標記、舊索引與複製清單。
+
+migrate 會將各用戶版本提升到舊索引版本之後並捨棄增量紀錄，客戶端下次讀取時
+取得完整列表，不會以舊索引的 ETag 或 since 誤判。輸出格式同 index_audit.py（JSON Lines）。
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+from file_index import load_index, update_index
+import key_layout
+from key_layout import LAYOUT_FLAT, LAYOUT_HASHED
+
+s3_client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+BUCKET_NAME = os.environ.get('BUCKET_NAME', 'awslambda0521')
+ACCESS_SUMMARY_KEY = 'stats/access/summary.json'
+MANIFEST_PREFIX = f'{key_layout.INDEX_SHARD_PREFIX}migrated/'
+
+def emit(record):
+    print(json.dumps(record, ensure_ascii=False), flush=True)
+
+def hashed_key(s3_key):
+    """舊鍵值對應的 hashed 鍵值；無法辨識的鍵值返回 None"""
+    parsed = key_layout.parse_object_key(s3_key)
+    if parsed is None:
+        return None
+    return key_layout.object_key(parsed[0], parsed[1], LAYOUT_HASHED)
+
+def copy_object(entry, new_key):
+    """複製物件到新鍵值（保留 metadata 與儲存類別，複製會重設 ACL）；來源已被刪除時返回 False"""
+    try:
+        s3_client.copy_object(
+            Bucket=BUCKET_NAME,
+            Key=new_key,
+            CopySource={'Bucket': BUCKET_NAME, 'Key': entry.s3_key},
+            MetadataDirective='COPY',
+            StorageClass=entry.storage_class,
+            ACL='public-read'
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise e
+
+def delete_keys(keys):
+    for start in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=BUCKET_NAME,
+            Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True}
+        )
+
+def manifest_key(shard_key):
+    return MANIFEST_PREFIX + shard_key.rsplit('/', 1)[-1]
+
+def load_manifest(shard_key):
+    """分片的複製清單 {用戶: 由 migrate 寫入分片的 hashed 鍵值集合}"""
+    try:
+        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=manifest_key(shard_key))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return {}
+        raise e
+    return {username: set(keys) for username, keys in json.loads(response['Body'].read()).items()}
+
+def save_manifest(shard_key, manifest):
+    s3_client.put_object(
+        Bucket=BUCKET_NAME,
+        Key=manifest_key(shard_key),
+        Body=json.dumps({username: sorted(keys) for username, keys in manifest.items() if keys}),
+        ContentType='application/json'
+    )
+
+def migrate_shard(executor, legacy, shard_key, usernames, batch_size, prune):
+    """將屬於同一分片的用戶複製到 hashed 鍵值，返回 (統計, {舊鍵值: 新鍵值})
+
+    prune 為 True（分片尚未使用）時移除分片中所有不在舊索引的記錄；
+    否則只移除複製清單中、舊索引已不存在的記錄（轉換期間 flat 配置的刪除與改名）。
+    """
+    totals = {'copied': 0, 'present': 0, 'missing': 0, 'pruned': 0}
+    key_map = {}
+    shard = load_index(s3_client, BUCKET_NAME, shard_key)
+    manifest = load_manifest(shard_key)
+
+    pending = []
+    expected = {}       # 用戶 -> 依舊索引應存在的 hashed 鍵值
+    for username in usernames:
+        present = {entry.s3_key for entry in shard.get(username, [])}
+        expected[username] = set()
+        for entry in legacy[username]:
+            new_key = hashed_key(entry.s3_key)
+            if new_key is None:
+                emit({'type': 'skipped', 'user': username, 's3Key': entry.s3_key})
+                continue
+            key_map[entry.s3_key] = new_key
+            expected[username].add(new_key)
+            if new_key in present:
+                totals['present'] += 1
+            else:
+                pending.append((username, entry, new_key))
+
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        # 分享參照只需改指向擁有者物件的新鍵值（物件由擁有者的記錄複製）
+        results = list(executor.map(lambda job: job[1].owner is not None or copy_object(job[1], job[2]), batch))
+
+        copied_jobs = []
+        for (username, entry, new_key), copied in zip(batch, results):
+            if not copied:
+                totals['missing'] += 1
+                emit({'type': 'missing', 'user': username, 's3Key': entry.s3_key})
+                continue
+            copied_jobs.append((username, entry, new_key))
+            manifest.setdefault(username, set()).add(new_key)
+            totals['copied'] += 1
+
+        # 先記入複製清單再寫入分片：清單多出的鍵值不影響判斷，反之則無法移除
+        save_manifest(shard_key, manifest)
+
+        # 轉換後半段分片已在使用中，以讀取-修改-條件寫入避免覆蓋 Lambda 的寫入
+        def add_batch(shard):
+            changed = False
+            for username, entry, new_key in copied_jobs:
+                user_files = shard.setdefault(username, [])
+                if all(existing.s3_key != new_key for existing in user_files):
+                    entry.s3_key = new_key
+                    user_files.append(entry)
+                    changed = True
+            return changed
+
+        update_index(s3_client, BUCKET_NAME, shard_key, add_batch)
+        emit({
+            'type': 'batch', 'shard': shard_key,
+            'copied': len(batch), 'remaining': len(pending) - start - len(batch)
+        })
+
+    stale_entries = []
+
+    def finish_shard(shard):
+        stale_entries.clear()
+        for username in set(usernames) | set(shard):
+            user_files = shard.get(username, [])
+            # 分片尚未使用時以舊索引為準；已在使用時只看由 migrate 複製的記錄
+            keep = expected.get(username, set())
+            migrated = manifest.get(username, set())
+            stale = [
+                entry for entry in user_files
+                if entry.s3_key not in keep and (prune or entry.s3_key in migrated)
+            ]
+            if stale:
+                user_files[:] = [entry for entry in user_files if entry not in stale]
+                stale_entries.extend((username, entry) for entry in stale)
+            if username not in usernames and not stale:
+                continue
+            user_files.sort(key=lambda entry: entry.uploaded_at)
+
+            # 版本接續在舊索引之後並捨棄增量紀錄，客戶端持有的舊版本一律取得完整列表
+            version = max(shard.user_version(username), legacy.user_version(username)) + 1
+            shard.user_versions[username] = version
+            shard.log_floors[username] = version
+            shard.change_logs.pop(username, None)
+        return bool(usernames or shard)
+
+    update_index(s3_client, BUCKET_NAME, shard_key, finish_shard)
+
+    if stale_entries:
+        # 分享參照指向擁有者的物件，只刪除自己擁有的複本
+        delete_keys([entry.s3_key for _, entry in stale_entries if entry.owner is None])
+        for username, entry in stale_entries:
+            manifest.get(username, set()).discard(entry.s3_key)
+            emit({'type': 'pruned', 'user': username, 's3Key': entry.s3_key})
+        save_manifest(shard_key, manifest)
+        totals['pruned'] = len(stale_entries)
+    return totals, key_map
+
+def copy_access_counters(key_map):
+    """為新鍵值複製存取計數；舊鍵值保留，storage_tiering 會依當時的配置捨棄不在索引中的一份"""
+    try:
+        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=ACCESS_SUMMARY_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return 0
+        raise e
+    summary = json.loads(response['Body'].read())
+
+    copied = 0
+    for old_key, (count, last_access) in list(summary.items()):
+        new_key = key_map.get(old_key)
+        if new_key is None:
+            continue
+        merged = summary.setdefault(new_key, [0, 0])
+        merged[0] = max(merged[0], count)
+        merged[1] = max(merged[1], last_access)
+        copied += 1
+    if copied:
+        s3_client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=ACCESS_SUMMARY_KEY,
+            Body=json.dumps(summary, separators=(',', ':')),
+            ContentType='application/json'
+        )
+    return copied
+
+def migrate(workers, batch_size):
+    prune = key_layout.KEY_LAYOUT != LAYOUT_HASHED
+    legacy = load_index(s3_client, BUCKET_NAME, key_layout.LEGACY_INDEX_KEY)
+
+    users_by_shard = {key: [] for key in key_layout.all_index_keys(LAYOUT_HASHED)}
+    for username in legacy:
+        users_by_shard[key_layout.index_key(username, LAYOUT_HASHED)].append(username)
+
+    totals = {'users': len(legacy), 'copied': 0, 'present': 0, 'missing': 0, 'pruned': 0, 'sharesUpdated': 0}
+    key_map = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for shard_key, usernames in users_by_shard.items():
+            shard_totals, shard_key_map = migrate_shard(executor, legacy, shard_key, usernames, batch_size, prune)
+            for name, count in shard_totals.items():
+                totals[name] += count
+            key_map.update(shard_key_map)
+
+        totals['sharesUpdated'] = reconcile_shares(executor)
+
+    totals['accessCounters'] = copy_access_counters(key_map)
+    emit({'type': 'summary', **totals})
+    return totals
+
+def reconcile_shares(executor):
+    """依各分片中實際存在的分享參照重設擁有者記錄的分享清單，返回更新的記錄數
+
+    轉換期間 flat 配置的分享與撤銷只反映在舊索引，複製或移除參照後擁有者的清單需隨之更新。
+    """
+    shard_keys = key_layout.all_index_keys(LAYOUT_HASHED)
+    recipients = {}     # (擁有者, s3Key) -> 持有參照的用戶
+    for shard in executor.map(lambda key: load_index(s3_client, BUCKET_NAME, key), shard_keys):
+        for username, entries in shard.items():
+            for entry in entries:
+                if entry.owner:
+                    recipients.setdefault((entry.owner, entry.s3_key), []).append(username)
+
+    updated = []
+
+    def mutate(shard):
+        updated.clear()
+        for username, entries in shard.items():
+            for entry in entries:
+                if entry.owner:
+                    continue
+                holders = recipients.get((username, entry.s3_key), [])
+                current = entry.shared_with or []
+                if set(current) == set(holders):
+                    continue
+                shared_with = [name for name in current if name in holders]
+                shared_with += [name for name in holders if name not in current]
+                entry.shared_with = shared_with or None
+                # 以同一鍵值的 rename 通知客戶端更新該記錄
+                shard.record_change(username, 'rename', entry.s3_key, entry.s3_key)
+                updated.append((username, entry.s3_key))
+        return bool(updated)
+
+    count = 0
+    for shard_key in shard_keys:
+        update_index(s3_client, BUCKET_NAME, shard_key, mutate)
+        for username, s3_key in updated:
+            emit({'type': 'shares', 'user': username, 's3Key': s3_key})
+        count += len(updated)
+    return count
+
+def cleanup_user(username, prefix, migrated_keys, apply):
+    """刪除用戶的舊鍵值物件；尚未複製到 hashed 鍵值的文件保留並列出"""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    deletable = []
+    kept = 0
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'] == prefix or hashed_key(obj['Key']) in migrated_keys:
+                deletable.append(obj['Key'])
+            else:
+                kept += 1
+                emit({'type': 'kept', 'user': username, 's3Key': obj['Key']})
+    if apply:
+        delete_keys(deletable)
+    return len(deletable), kept
+
+def cleanup(workers, apply):
+    if key_layout.KEY_LAYOUT != LAYOUT_HASHED:
+        emit({'type': 'error', 'message': '請先以 KEY_LAYOUT=hashed 部署並執行 migrate 後再清除舊鍵值'})
+        return None
+
+    migrated_keys = set()
+    for shard_key in key_layout.all_index_keys():
+        for entries in load_index(s3_client, BUCKET_NAME, shard_key).values():
+            migrated_keys.update(entry.s3_key for entry in entries)
+
+    totals = {'users': 0, 'deleted': 0, 'kept': 0, 'applied': apply}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(cleanup_user, username, prefix, migrated_keys, apply)
+            for username, prefix in key_layout.iter_user_prefixes(s3_client, BUCKET_NAME, LAYOUT_FLAT)
+        ]
+        for future in futures:
+            deleted, kept = future.result()
+            totals['users'] += 1
+            totals['deleted'] += deleted
+            totals['kept'] += kept
+
+    # 舊索引與複製清單只在所有舊物件都已清除後才刪除，保留重新執行 migrate 的可能
+    if apply and not totals['kept']:
+        delete_keys([key_layout.LEGACY_INDEX_KEY] + [manifest_key(key) for key in key_layout.all_index_keys()])
+    emit({'type': 'summary', **totals})
+    return totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='文件鍵值配置轉換工具（flat -> hashed）')
+    parser.add_argument('--workers', type=int, default=32, help='並行複製 / 刪除的執行緒數')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='複製物件到 hashed 鍵值並寫入索引分片')
+    migrate_parser.add_argument('--batch', type=int, default=500, help='每批複製的文件數（每批完成後寫入分片）')
+    cleanup_parser = subparsers.add_parser('cleanup', help='刪除已轉換的舊鍵值物件與舊索引')
+    cleanup_parser.add_argument('--apply', action='store_true', help='實際刪除（預設僅預覽）')
+    args = parser.parse_args(argv)
+
+    if args.command == 'migrate':
+        totals = migrate(args.workers, args.batch)
+        return 1 if totals['missing'] else 0
+    totals = cleanup(args.workers, args.apply)
+    return 1 if totals is None or totals['kept'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
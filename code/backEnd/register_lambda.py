@@ -1,11 +1,15 @@
 import json
+import os
 import boto3
 import hashlib
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
+from analytics import record_event
 
-s3_client = boto3.client('s3')
-BUCKET_NAME = 'awslambda0521'
+s3_client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+io_executor = ThreadPoolExecutor(max_workers=2)
+BUCKET_NAME = os.environ.get('BUCKET_NAME', 'awslambda0521')
 USERS_INDEX_KEY = 'users/users.json'
 USERS_PROFILES_PREFIX = 'users/profiles/'
 
@@ -61,6 +65,9 @@ def lambda_handler(event, context):
             'isActive': True
         }
 
+        # 記錄管理員統計事件（單次寫入，由 analytics.fold_events 彙整），與下列寫入並行
+        analytics_future = io_executor.submit(record_event, s3_client, BUCKET_NAME, 'register', username)
+
         # 寫入個人資料檔案
         s3_client.put_object(
             Bucket=BUCKET_NAME,
@@ -80,6 +87,8 @@ def lambda_handler(event, context):
             ContentType='application/json'
         )
 
+        analytics_future.result()
+
         print(f"User {username} created successfully.")
         return {
             'statusCode': 201,
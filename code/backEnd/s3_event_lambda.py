@@ -0,0 +1,150 @@
+import json
+import os
+import boto3
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from file_index import FileEntry, load_index, update_index, parse_iso_ms, now_ms
+from key_layout import parse_object_key, user_prefix, index_key
+
+s3_client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+BUCKET_NAME = os.environ.get('BUCKET_NAME', 'awslambda0521')
+
+MAX_IO_WORKERS = int(os.environ.get('MAX_IO_WORKERS', '8'))
+io_executor = ThreadPoolExecutor(max_workers=MAX_IO_WORKERS)
+
+def lambda_handler(event, context):
+    """處理 S3 ObjectCreated / ObjectRemoved 通知，批次更新用戶文件索引"""
+    records = event.get('Records', [])
+    print(f"Received {len(records)} S3 event records")
+
+    try:
+        # 依用戶與物件分組；同一物件的多筆事件只保留最後一筆（以 sequencer 排序）
+        latest = {}
+        for record in records:
+            parsed = parse_record(record)
+            if parsed is None:
+                continue
+            username, s3_key = parsed['username'], parsed['s3Key']
+            previous = latest.get((username, s3_key))
+            if previous is None or parsed['sequencer'] >= previous['sequencer']:
+                latest[(username, s3_key)] = parsed
+
+        if not latest:
+            return {'statusCode': 200, 'body': json.dumps({'added': 0, 'removed': 0})}
+
+        # 依用戶所在的索引分組（hashed 配置下索引分散為多個分片）
+        items_by_index = {}
+        for item in latest.values():
+            items_by_index.setdefault(index_key(item['username']), []).append(item)
+
+        # 新增的物件需要 HEAD 取得原始檔名與 Content-Type，與各索引讀取並行執行
+        created = [item for item in latest.values() if item['created']]
+        index_futures = {
+            key: io_executor.submit(load_index, s3_client, BUCKET_NAME, key)
+            for key in items_by_index
+        }
+        head_futures = [io_executor.submit(build_entry, item) for item in created]
+        entries = [future.result() for future in head_futures]
+
+        # 同一索引內所有用戶的變更合併為一次條件寫入，與 Lambda 的寫入衝突時重新讀取並重新套用
+        update_futures = [
+            io_executor.submit(update_shard, key, items, entries, index_futures[key].result())
+            for key, items in items_by_index.items()
+        ]
+        added = 0
+        removed = 0
+        for future in update_futures:
+            index_added, index_removed = future.result()
+            added += index_added
+            removed += index_removed
+
+        print(f"Index updated from S3 events: {added} added, {removed} removed")
+        return {'statusCode': 200, 'body': json.dumps({'added': added, 'removed': removed})}
+
+    except Exception as e:
+        # 拋出例外讓 Lambda 重試整批事件（索引更新為冪等操作）
+        print(f"Error applying S3 events: {str(e)}")
+        raise e
+
+def parse_record(record):
+    """解析單筆 S3 事件，非用戶文件（索引、目錄標記、其他前綴）返回 None"""
+    event_name = record.get('eventName', '')
+    s3_info = record.get('s3', {})
+    if s3_info.get('bucket', {}).get('name', BUCKET_NAME) != BUCKET_NAME:
+        return None
+
+    object_info = s3_info.get('object', {})
+    s3_key = unquote_plus(object_info.get('key', ''))
+    parsed = parse_object_key(s3_key)
+    if parsed is None:
+        return None
+    username = parsed[0]
+
+    # 只處理目前配置下的物件；轉換配置期間的複製與清除不應改變索引
+    if not s3_key.startswith(user_prefix(username)):
+        return None
+
+    if event_name.startswith('ObjectCreated'):
+        created = True
+    elif event_name.startswith('ObjectRemoved') or event_name.startswith('LifecycleExpiration'):
+        created = False
+    else:
+        return None
+
+    return {
+        'username': username,
+        's3Key': s3_key,
+        'created': created,
+        'size': object_info.get('size', 0),
+        'eventTime': parse_iso_ms(record.get('eventTime')) or now_ms(),
+        # sequencer 為長度不一的十六進位字串，補齊長度後才能依字串比較先後
+        'sequencer': object_info.get('sequencer', '').zfill(32)
+    }
+
+def build_entry(item):
+    """以 HEAD 取得物件 metadata 建立索引記錄；物件已不存在時返回 None"""
+    try:
+        head = s3_client.head_object(Bucket=BUCKET_NAME, Key=item['s3Key'])
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            print(f"Object already gone, skipping: {item['s3Key']}")
+            return None
+        raise e
+
+    return FileEntry.from_head(item['s3Key'], head, uploaded_at=item['eventTime'])
+
+def update_shard(key, items, entries, files_index):
+    """將事件套用到一個索引並條件寫入，返回最後一次套用的 (新增數, 移除數)"""
+    counts = [0, 0]
+
+    def mutate(files_index):
+        counts[:] = apply_changes(files_index, items, entries)
+        return any(counts)
+
+    update_index(s3_client, BUCKET_NAME, key, mutate, files_index)
+    return tuple(counts)
+
+def apply_changes(files_index, items, entries):
+    """將事件套用到索引，已存在的新增與不存在的刪除會被略過（重送事件不會重複記錄）"""
+    entries_by_key = {entry.s3_key: entry for entry in entries if entry is not None}
+    added = 0
+    removed = 0
+    for item in items:
+        username, s3_key = item['username'], item['s3Key']
+        user_files = files_index.get(username, [])
+        position = next((i for i, entry in enumerate(user_files) if entry.s3_key == s3_key), -1)
+
+        if item['created']:
+            entry = entries_by_key.get(s3_key)
+            if entry is None or position >= 0:
+                continue
+            files_index.setdefault(username, user_files).append(entry)
+            files_index.record_change(username, 'add', s3_key)
+            added += 1
+        elif position >= 0:
+            user_files.pop(position)
+            files_index.record_change(username, 'remove', s3_key)
+            removed += 1
+
+    return added, removed
@@ -0,0 +1,149 @@
+import json
+import os
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from file_index import load_index, update_index, now_ms
+from key_layout import all_index_keys
+
+s3_client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+BUCKET_NAME = os.environ.get('BUCKET_NAME', 'awslambda0521')
+
+# 存取計數：file manipulate_lambda 寫入的批次檔，以及合併後的彙總檔 {s3Key: [次數, 最後存取 epoch ms]}
+ACCESS_BATCH_PREFIX = 'stats/access/batches/'
+ACCESS_SUMMARY_KEY = 'stats/access/summary.json'
+
+# 超過 TIERING_DAYS 天未被存取（或上傳、修改）的文件移至 COLD_STORAGE_CLASS
+TIERING_DAYS = int(os.environ.get('TIERING_DAYS', '30'))
+COLD_STORAGE_CLASS = os.environ.get('COLD_STORAGE_CLASS', 'STANDARD_IA')
+# STANDARD_IA 以 128 KB 為最小計費單位，較小的文件轉換後反而更貴
+MIN_TIERING_BYTES = 128 * 1024
+
+MAX_IO_WORKERS = int(os.environ.get('MAX_IO_WORKERS', '16'))
+DAY_MS = 24 * 60 * 60 * 1000
+
+def lambda_handler(event, context):
+    """排程執行（EventBridge）：合併存取計數，將冷文件轉為低頻存取儲存類別並記錄於索引"""
+    event = event or {}
+    days = int(event.get('days', TIERING_DAYS))
+    dry_run = bool(event.get('dryRun', False))
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_IO_WORKERS) as executor:
+            # hashed 配置下索引分散為多個分片，並行讀取後一併處理
+            index_keys = all_index_keys()
+            files_indexes = executor.map(lambda key: load_index(s3_client, BUCKET_NAME, key), index_keys)
+            all_entries = [
+                entry
+                for files_index in files_indexes
+                for entries in files_index.values()
+                for entry in entries
+            ]
+            summary = merge_access_batches(executor, {entry.s3_key for entry in all_entries}, dry_run)
+
+            cutoff = now_ms() - days * DAY_MS
+            candidates = []
+            for entry in all_entries:
+                # 分享參照與擁有者記錄指向同一物件，只以擁有者記錄判斷
+                if entry.owner:
+                    continue
+                last_touched = max(entry.uploaded_at, entry.modified_at, summary.get(entry.s3_key, [0, 0])[1])
+                if (entry.storage_class == 'STANDARD'
+                        and entry.size_bytes >= MIN_TIERING_BYTES
+                        and last_touched < cutoff):
+                    candidates.append(entry)
+
+            if dry_run:
+                moved = candidates
+            else:
+                results = executor.map(transition_entry, candidates)
+                moved = [entry for entry, ok in zip(candidates, results) if ok]
+                if moved:
+                    moved_keys = {entry.s3_key for entry in moved}
+                    list(executor.map(lambda key: record_tiers(key, moved_keys), index_keys))
+
+        result = {
+            'candidates': len(candidates),
+            'moved': len(moved),
+            'movedBytes': sum(entry.size_bytes for entry in moved),
+            'dryRun': dry_run
+        }
+        print(f"Storage tiering finished: {json.dumps(result)}")
+        return {'statusCode': 200, 'body': json.dumps(result)}
+
+    except Exception as e:
+        print(f"Error running storage tiering: {str(e)}")
+        raise e
+
+def merge_access_batches(executor, live_keys, dry_run):
+    """將所有計數批次合併進彙總檔，並移除已不在索引中的文件；返回合併後的彙總"""
+    try:
+        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=ACCESS_SUMMARY_KEY)
+        summary = json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise e
+        summary = {}
+
+    batch_keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=ACCESS_BATCH_PREFIX):
+        batch_keys.extend(obj['Key'] for obj in page.get('Contents', []))
+
+    for batch in executor.map(read_batch, batch_keys):
+        for s3_key, (count, last_access) in batch.items():
+            merged = summary.setdefault(s3_key, [0, 0])
+            merged[0] += count
+            merged[1] = max(merged[1], last_access)
+
+    summary = {s3_key: counter for s3_key, counter in summary.items() if s3_key in live_keys}
+
+    if not dry_run and batch_keys:
+        # 先寫入彙總再刪除批次，失敗時最多重複計數而不會遺失
+        s3_client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=ACCESS_SUMMARY_KEY,
+            Body=json.dumps(summary, separators=(',', ':')),
+            ContentType='application/json'
+        )
+        for start in range(0, len(batch_keys), 1000):
+            s3_client.delete_objects(
+                Bucket=BUCKET_NAME,
+                Delete={'Objects': [{'Key': key} for key in batch_keys[start:start + 1000]], 'Quiet': True}
+            )
+        print(f"Merged {len(batch_keys)} access batches into {ACCESS_SUMMARY_KEY}")
+
+    return summary
+
+def record_tiers(index_key, moved_keys):
+    """將新的儲存類別寫入索引；轉換期間可能有新的上傳，以讀取-修改-條件寫入套用到最新索引"""
+    def mutate(files_index):
+        changed = False
+        for entries in files_index.values():
+            for entry in entries:
+                if entry.s3_key in moved_keys and entry.storage_class != COLD_STORAGE_CLASS:
+                    entry.storage_class = COLD_STORAGE_CLASS
+                    changed = True
+        return changed
+
+    update_index(s3_client, BUCKET_NAME, index_key, mutate)
+
+def read_batch(batch_key):
+    response = s3_client.get_object(Bucket=BUCKET_NAME, Key=batch_key)
+    return json.loads(response['Body'].read())
+
+def transition_entry(entry):
+    """以就地複製變更物件的儲存類別（複製會重設 ACL，需重新指定 public-read）"""
+    try:
+        s3_client.copy_object(
+            Bucket=BUCKET_NAME,
+            Key=entry.s3_key,
+            CopySource={'Bucket': BUCKET_NAME, 'Key': entry.s3_key},
+            StorageClass=COLD_STORAGE_CLASS,
+            MetadataDirective='COPY',
+            ACL='public-read'
+        )
+        return True
+    except ClientError as e:
+        print(f"Error transitioning {entry.s3_key}: {str(e)}")
+        return False
@@ -0,0 +1,175 @@
+"""FileIndex 變更紀錄與增量合併（changes_since）測試"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_index import CHANGE_LOG_LIMIT, CHANGE_LOG_MIN, FileEntry, FileIndex, decode_index, encode_index, save_index
+
+A = 'files/alice/a.txt'
+B = 'files/alice/b.txt'
+C = 'files/alice/c.txt'
+
+class ChangesSinceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.files_index = FileIndex()
+
+    def record(self, *changes):
+        for change in changes:
+            self.files_index.record_change('alice', *change)
+
+    def changes(self, since):
+        return self.files_index.changes_since('alice', since)
+
+    def test_versions_increase_per_user(self):
+        self.assertEqual(self.files_index.record_change('alice', 'add', A), 1)
+        self.assertEqual(self.files_index.record_change('alice', 'add', B), 2)
+        self.assertEqual(self.files_index.record_change('bob', 'add', C), 1)
+        self.assertEqual(self.files_index.user_version('alice'), 2)
+        self.assertEqual(self.files_index.user_version('carol'), 0)
+
+    def test_no_changes(self):
+        self.assertEqual(self.changes(0), ([], [], {}))
+        self.record(('add', A))
+        self.assertEqual(self.changes(1), ([], [], {}))
+
+    def test_only_changes_after_since(self):
+        self.record(('add', A), ('add', B), ('remove', A))
+        self.assertEqual(self.changes(0), ([B], [], {}))
+        self.assertEqual(self.changes(1), ([B], [A], {}))
+        self.assertEqual(self.changes(2), ([], [A], {}))
+
+    def test_add_then_remove_cancels(self):
+        self.record(('add', A), ('remove', A))
+        self.assertEqual(self.changes(0), ([], [], {}))
+
+    def test_add_then_rename_is_added_under_new_key(self):
+        self.record(('add', A), ('rename', A, B), ('rename', B, C))
+        self.assertEqual(self.changes(0), ([C], [], {}))
+
+    def test_add_rename_remove_chain_cancels(self):
+        self.record(('add', A), ('rename', A, B), ('remove', B))
+        self.assertEqual(self.changes(0), ([], [], {}))
+
+    def test_rename_chain_maps_from_known_key(self):
+        self.record(('add', A), ('rename', A, B), ('rename', B, C))
+        self.assertEqual(self.changes(1), ([], [], {A: C}))
+
+    def test_rename_then_remove_removes_known_key(self):
+        self.record(('add', A), ('rename', A, B), ('rename', B, C), ('remove', C))
+        self.assertEqual(self.changes(1), ([], [A], {}))
+
+    def test_rename_back_to_original_key(self):
+        self.record(('add', A), ('rename', A, B), ('rename', B, A))
+        self.assertEqual(self.changes(1), ([], [], {A: A}))
+
+    def test_remove_then_add_same_key(self):
+        self.record(('add', A), ('remove', A), ('add', A))
+        self.assertEqual(self.changes(1), ([A], [A], {}))
+
+    def test_touch_is_self_rename(self):
+        # touch_entry 以同一鍵值的 rename 通知客戶端更新記錄內容（如分享清單）
+        self.record(('add', A), ('rename', A, A))
+        self.assertEqual(self.changes(1), ([], [], {A: A}))
+        self.assertEqual(self.changes(0), ([A], [], {}))
+
+    def test_touch_then_rename(self):
+        self.record(('add', A), ('rename', A, A), ('rename', A, B))
+        self.assertEqual(self.changes(1), ([], [], {A: B}))
+
+    def test_touch_then_remove(self):
+        self.record(('add', A), ('rename', A, A), ('rename', A, A), ('remove', A))
+        self.assertEqual(self.changes(1), ([], [A], {}))
+
+    def test_rename_then_touch(self):
+        self.record(('add', A), ('rename', A, B), ('rename', B, B))
+        self.assertEqual(self.changes(1), ([], [], {A: B}))
+
+    def test_since_ahead_of_version(self):
+        self.record(('add', A))
+        self.assertIsNone(self.changes(2))
+
+    def test_users_are_independent(self):
+        self.record(('add', A))
+        self.files_index.record_change('bob', 'add', C)
+        self.assertEqual(self.changes(0), ([A], [], {}))
+        self.assertEqual(self.files_index.changes_since('bob', 0), ([C], [], {}))
+
+class ChangeLogTruncationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.files_index = FileIndex()
+        self.files_index['alice'] = []
+        self.extra = 5
+        for i in range(CHANGE_LOG_LIMIT + self.extra):
+            s3_key = f'files/alice/{i}.txt'
+            self.files_index['alice'].append(FileEntry(f'{i}.txt', s3_key, 1, i, 'text/plain'))
+            self.files_index.record_change('alice', 'add', s3_key)
+
+    def test_log_is_bounded(self):
+        log = self.files_index.change_logs['alice']
+        self.assertEqual(len(log), CHANGE_LOG_LIMIT)
+        self.assertEqual(log[0][0], self.extra + 1)
+        self.assertEqual(self.files_index.log_floors['alice'], self.extra)
+
+    def test_since_before_floor_needs_full_list(self):
+        for since in range(self.extra):
+            self.assertIsNone(self.files_index.changes_since('alice', since))
+
+    def test_since_at_floor_is_complete(self):
+        added, removed, renamed = self.files_index.changes_since('alice', self.extra)
+        self.assertEqual(len(added), CHANGE_LOG_LIMIT)
+        self.assertEqual(added[0], f'files/alice/{self.extra}.txt')
+        self.assertEqual((removed, renamed), ([], {}))
+
+    def test_floor_survives_encoding(self):
+        decoded = decode_index(encode_index(self.files_index))
+        self.assertIsNone(decoded.changes_since('alice', self.extra - 1))
+        self.assertEqual(decoded.changes_since('alice', self.extra),
+                         self.files_index.changes_since('alice', self.extra))
+
+class RecordingClient:
+    """只記錄 put_object 內容的 S3 用戶端"""
+
+    def put_object(self, Body, **kwargs):
+        self.body = Body
+        return {'ETag': '"saved"'}
+
+class ChangeLogFileCountLimitTest(unittest.TestCase):
+    """紀錄上限隨用戶文件數縮放，避免少量文件的用戶以變更紀錄撐大共用索引"""
+
+    def setUp(self):
+        self.files_index = FileIndex()
+        self.files_index['alice'] = [FileEntry(f'{i}.txt', f'files/alice/{i}.txt', 1, i, 'text/plain')
+                                     for i in range(CHANGE_LOG_MIN + 2)]
+
+    def test_limit_follows_file_count(self):
+        self.assertEqual(self.files_index.change_log_limit('alice'), CHANGE_LOG_MIN + 2)
+        self.assertEqual(self.files_index.change_log_limit('bob'), CHANGE_LOG_MIN)
+
+    def test_touches_beyond_file_count_fall_back_to_full_list(self):
+        for _ in range(3):
+            for entry in self.files_index['alice']:
+                self.files_index.record_change('alice', 'rename', entry.s3_key, entry.s3_key)
+        count = len(self.files_index['alice'])
+        version = self.files_index.user_version('alice')
+        self.assertEqual(len(self.files_index.change_logs['alice']), count)
+        self.assertIsNone(self.files_index.changes_since('alice', version - count - 1))
+        _, _, renamed = self.files_index.changes_since('alice', version - count)
+        self.assertEqual(len(renamed), count)
+
+    def test_save_trims_after_files_are_removed(self):
+        for entry in self.files_index['alice']:
+            self.files_index.record_change('alice', 'rename', entry.s3_key, entry.s3_key)
+        del self.files_index['alice'][1:]
+        client = RecordingClient()
+        save_index(client, 'awslambda0521', 'files/user_files_index.json', self.files_index)
+        saved = decode_index(client.body)
+        self.assertEqual(len(saved.change_logs['alice']), CHANGE_LOG_MIN)
+        self.assertEqual(len(self.files_index.change_logs['alice']), CHANGE_LOG_MIN)
+        self.assertEqual(self.files_index.log_floors['alice'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+"""舊版 JSON 索引與精簡欄式索引的編碼 / 解碼測試"""
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_index import FileEntry, FileIndex, decode_index, encode_index, parse_iso_ms
+
+LEGACY_INDEX = {
+    'alice': [
+        {
+            'name': '報告.pdf',
+            'uniqueName': 'report_20240101_100000.pdf',
+            's3Key': 'files/alice/report_20240101_100000.pdf',
+            'url': 'https://awslambda0521.s3.amazonaws.com/files/alice/report_20240101_100000.pdf',
+            'size': '2.0 KB',
+            'uploadDate': '2024-01-01',
+            'uploadTime': '2024-01-01T10:00:00.000Z',
+            'type': 'application/pdf'
+        },
+        {
+            'name': 'photo.png',
+            'uniqueName': 'photo_20240102_120000.png',
+            's3Key': 'files/alice/photo_20240102_120000.png',
+            'url': 'https://awslambda0521.s3.amazonaws.com/files/alice/photo_20240102_120000.png',
+            'size': '512.0 B',
+            'uploadDate': '2024-01-02',
+            'uploadTime': '2024-01-02T12:00:00.000Z',
+            'type': 'image/png',
+            'lastModified': '2024-01-03',
+            'lastModifiedTime': '2024-01-03T08:30:00.000Z'
+        }
+    ],
+    'bob': []
+}
+
+def entry_fields(entry):
+    return {name: getattr(entry, name) for name in FileEntry.__slots__}
+
+def index_fields(files_index):
+    return {username: [entry_fields(entry) for entry in entries] for username, entries in files_index.items()}
+
+class LegacyDecodeTest(unittest.TestCase):
+
+    def test_legacy_fields_are_parsed(self):
+        files_index = decode_index(json.dumps(LEGACY_INDEX).encode('utf-8'))
+
+        self.assertEqual(files_index.version, 0)
+        self.assertEqual(files_index['bob'], [])
+        report, photo = files_index['alice']
+        self.assertEqual(report.name, '報告.pdf')
+        self.assertEqual(report.size_bytes, 2048)
+        self.assertEqual(report.uploaded_at, parse_iso_ms('2024-01-01T10:00:00.000Z'))
+        self.assertEqual(report.modified_at, 0)
+        self.assertEqual(report.storage_class, 'STANDARD')
+        self.assertEqual(photo.modified_at, parse_iso_ms('2024-01-03T08:30:00.000Z'))
+
+    def test_legacy_round_trip_keeps_response(self):
+        files_index = decode_index(json.dumps(LEGACY_INDEX).encode('utf-8'))
+        decoded = decode_index(encode_index(files_index))
+
+        self.assertEqual(index_fields(decoded), index_fields(files_index))
+        # 精簡格式推導出的回應包含舊版記錄的所有欄位且值相同
+        for legacy, entry in zip(LEGACY_INDEX['alice'], decoded['alice']):
+            response = entry.to_response('awslambda0521')
+            self.assertEqual({name: response.get(name) for name in legacy}, legacy)
+
+    def test_empty_index(self):
+        self.assertEqual(decode_index(b''), {})
+        self.assertEqual(decode_index(encode_index(FileIndex())), {})
+
+class CompactRoundTripTest(unittest.TestCase):
+
+    def build_index(self):
+        files_index = FileIndex(version=7)
+        files_index['alice'] = [
+            FileEntry('a.txt', 'files/alice/a.txt', 10, 1700000000000, 'text/plain'),
+            FileEntry('b.bin', 'files/alice/b.bin', 4096, 1700000001000, 'application/octet-stream',
+                      modified_at=1700000002000, storage_class='GLACIER_IR', shared_with=['bob'])
+        ]
+        files_index['bob'] = [
+            FileEntry('b.bin', 'files/alice/b.bin', 4096, 1700000003000, 'application/octet-stream',
+                      owner='alice'),
+            FileEntry('c.txt', 'files/bob/c.txt', 1, 1700000004000, 'text/plain', storage_class='STANDARD_IA')
+        ]
+        files_index['carol'] = [
+            FileEntry('d.txt', 'files/carol/d.txt', 0, 1700000005000, 'text/plain')
+        ]
+        files_index.record_change('alice', 'add', 'files/alice/a.txt')
+        files_index.record_change('alice', 'rename', 'files/alice/b.bin', 'files/alice/b.bin')
+        files_index.record_change('bob', 'add', 'files/alice/b.bin')
+        files_index.log_floors['carol'] = 3
+        files_index.user_versions['carol'] = 5
+        return files_index
+
+    def test_round_trip(self):
+        files_index = self.build_index()
+        decoded = decode_index(encode_index(files_index))
+
+        self.assertIsInstance(decoded, FileIndex)
+        self.assertEqual(decoded.version, 7)
+        self.assertEqual(index_fields(decoded), index_fields(files_index))
+        self.assertEqual(decoded.user_versions, {'alice': 2, 'bob': 1, 'carol': 5})
+        self.assertEqual(decoded.change_logs, files_index.change_logs)
+        self.assertEqual(decoded.log_floors, {'carol': 3})
+        # 再次編碼結果一致
+        self.assertEqual(encode_index(decoded), encode_index(files_index))
+
+    def test_sharing_columns_only_when_used(self):
+        users = json.loads(encode_index(self.build_index()))['users']
+
+        self.assertEqual(users['alice']['sharedWith'], [None, ['bob']])
+        self.assertNotIn('owner', users['alice'])
+        self.assertEqual(users['bob']['owner'], ['alice', None])
+        self.assertNotIn('sharedWith', users['bob'])
+        self.assertNotIn('owner', users['carol'])
+        self.assertNotIn('sharedWith', users['carol'])
+
+    def test_content_types_are_dictionary_encoded(self):
+        document = json.loads(encode_index(self.build_index()))
+
+        self.assertEqual(document['types'], ['text/plain', 'application/octet-stream'])
+        self.assertEqual(document['users']['bob']['type'], [1, 0])
+
+    def test_plain_dict_encodes_without_versions(self):
+        files_index = self.build_index()
+        decoded = decode_index(encode_index(dict(files_index)))
+
+        self.assertEqual(decoded.version, 0)
+        self.assertEqual(index_fields(decoded), index_fields(files_index))
+        self.assertEqual(decoded.change_logs, {})
+
+if __name__ == '__main__':
+    unittest.main()